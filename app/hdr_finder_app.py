@@ -25,25 +25,37 @@ class HDRProcessedImages(LockingProcessedImages):
         # ''')
         # #self.conn.execute('''CREATE UNIQUE INDEX IF NOT EXISTS photos_filename_ids on photos(filename);''')
 
+    def load(self):
+        super().load()
+        tag = config['hdr_finder']['exposure_comp_tag']
+        exposure_compensation = self.exif_expression(tag)
+        if tag in self.exif_columns.values():
+            # Covers the sequence query below, so it's a walk of this index without touching the photos table
+            self._run_query(f'''
+                CREATE INDEX IF NOT EXISTS photos_hdr_sequence ON photos(filetype, deleted, filename, date_taken, {exposure_compensation});
+            ''')
+
     def find_hdr_groups(self):
+        exposure_compensation = self.exif_expression(config['hdr_finder']['exposure_comp_tag'])
+
         # STEP 1: Create a view of all sequences of three photos:
         logger.debug('''Create temp table of all sequences of three raw photos''')
-        self._run_query("""
+        self._run_query(f"""
             CREATE TEMP VIEW IF NOT EXISTS v_raw_sequence AS
                 SELECT 
                     -- First photo in sequence, two rows previous ordered by filename/ date taken
                     LAG (filename, 2, 0) OVER (ORDER BY filename, date_taken) AS filename1,
-                    CAST(LAG (json_extract(exif_data, '$.EXIF:ExposureCompensation'), 2, 0) OVER (ORDER BY filename, date_taken) AS REAL) AS exc1,
+                    CAST(LAG ({exposure_compensation}, 2, 0) OVER (ORDER BY filename, date_taken) AS REAL) AS exc1,
 
                     -- Second photo in sequence, one row previous ordered by filename/date taken
                     LAG (filename, 1, 0) OVER (ORDER BY filename, date_taken) AS filename2,
-                    CAST(LAG (json_extract(exif_data, '$.EXIF:ExposureCompensation'), 1, 0) OVER (ORDER BY filename, date_taken) AS REAL) AS exc2,
+                    CAST(LAG ({exposure_compensation}, 1, 0) OVER (ORDER BY filename, date_taken) AS REAL) AS exc2,
 
                     -- Third photo in sequence (this row)
                     filename AS filename3,
-                    CAST(json_extract(exif_data, '$.EXIF:ExposureCompensation') AS REAL) AS exc3
+                    CAST({exposure_compensation} AS REAL) AS exc3
                 FROM photos 
-                WHERE filetype = 'RAW'
+                WHERE filetype = 'RAW' AND deleted = 0
         """)
 
 
@@ -1,38 +1,153 @@
 import subprocess
 import os
 import json
+import select
+import time
+
+from threading import Lock
+from queue import Queue, Empty
 
 import logging
 logger = logging.getLogger(__name__)
 
 class ExifTool(object):
-    sentinel = "{ready}" + os.linesep
+    sentinel = ("{ready}" + os.linesep).encode('utf-8')
 
-    def __init__(self, executable="exiftool"):
+    def __init__(self, executable="exiftool", timeout=None):
         self.executable = executable
+        # Seconds to wait for a result before the process is taken to be hung and killed, None to wait forever
+        self.timeout = timeout
+        self.process = None
 
     def __enter__(self):
+        self.start()
+        return self
+
+    def  __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
         logger.debug('starting exiftool')
         self.process = subprocess.Popen(
             [self.executable, "-stay_open", "True",  "-@", "-"],
             universal_newlines=True,
             stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-        return self
 
-    def  __exit__(self, exc_type, exc_value, traceback):
-        self.process.stdin.write("-stay_open\nFalse\n")
-        self.process.stdin.flush()
+    def stop(self):
+        if not self.is_running():
+            return
+        try:
+            self.process.stdin.write("-stay_open\nFalse\n")
+            self.process.stdin.flush()
+            self.process.wait(timeout=10)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            logger.warning(f'exiftool did not exit cleanly, killing it: {e}')
+            self.process.kill()
         logger.debug('closed exiftool')
 
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
     def execute(self, *args):
         args = args + ("-execute\n",)
         self.process.stdin.write(str.join("\n", args))
         self.process.stdin.flush()
-        output = ""
+        output = b""
         fd = self.process.stdout.fileno()
+        deadline = None if self.timeout is None else time.time() + self.timeout
         while not output.endswith(self.sentinel):
-            output += os.read(fd, 4096).decode('utf-8')
-        return output[:-len(self.sentinel)]
+            if deadline is not None:
+                ready, _, _ = select.select([fd], [], [], max(deadline - time.time(), 0))
+                if not ready:
+                    # Killed so it's replaced the same as one that crashed
+                    self.process.kill()
+                    self.process.wait()
+                    raise TimeoutError(f'exiftool did not return a result within {self.timeout}s')
+            chunk = os.read(fd, 4096)
+            if not chunk:
+                raise IOError('exiftool exited before returning a result')
+            output += chunk
+        return output[:-len(self.sentinel)].decode('utf-8')
 
     def get_metadata(self, *filenames):
         return json.loads(self.execute("-G", "-j", "-n", *filenames))
+
+
+class ExifToolPool(object):
+    """
+    A fixed number of long running exiftool processes, shared between threads.
+    Each call checks out a process, and a process that has died or hung is restarted
+    the next time it's checked out. Processes always go back in the pool, so one that
+    fails to restart is tried again on the next call rather than lost.
+    """
+    def __init__(self, size, executable="exiftool", timeout=None):
+        self.size = size
+        self.executable = executable
+        self.timeout = timeout
+        self.workers = Queue()
+
+        self.stats_lock = Lock()
+        self.processes_started = 0
+        self.calls = 0
+        self.call_time = 0.0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        logger.info(f'starting pool of {self.size} exiftool processes')
+        for _ in range(self.size):
+            worker = ExifTool(self.executable, self.timeout)
+            self._start_worker(worker)
+            self.workers.put(worker)
+
+    def stop(self):
+        logger.info(f'stopping exiftool pool: {self.get_stats()}')
+        while True:
+            try:
+                self.workers.get_nowait().stop()
+            except Empty:
+                break
+
+    def _start_worker(self, worker):
+        worker.start()
+        with self.stats_lock:
+            self.processes_started += 1
+
+    def get_metadata(self, *filenames):
+        worker = self.workers.get()
+        try:
+            if not worker.is_running():
+                logger.warning('exiftool process exited, starting a new one')
+                try:
+                    self._start_worker(worker)
+                except Exception as e:
+                    logger.error(f'unable to start exiftool: {e}')
+                    raise
+
+            start = time.time()
+            try:
+                return worker.get_metadata(*filenames)
+            except OSError:
+                # Broken pipe, early exit or timeout, the process can't be trusted to be in sync any more.
+                worker.stop()
+                raise
+            finally:
+                with self.stats_lock:
+                    self.calls += 1
+                    self.call_time += time.time() - start
+        finally:
+            self.workers.put(worker)
+
+    def get_stats(self):
+        with self.stats_lock:
+            return {
+                'processes_started': self.processes_started,
+                'calls': self.calls,
+                'call_time': self.call_time,
+                'average_call_time': self.call_time / self.calls if self.calls else 0.0
+            }
@@ -25,25 +25,29 @@ import rawpy
 
 import os
 from io import BytesIO
-import base64
 
 import scipy.stats as stats
 
-from exiftool import ExifTool
+from ingest.exiftool import ExifTool
 
 import logging
 logger = logging.getLogger(__name__)
 
 
 class Image(object):
-    def __init__(self, filename):
+    def __init__(self, filename, exiftool=None, exif_data=None):
         self.filename = filename
         self.location = None
         self.date_taken = None
-        self.load_file(filename)
+        self.exif_data = dict()
+        self.load_file(filename, exiftool, exif_data)
 
-    def load_file(self, filename):
-        self.load_exif()
+    def load_file(self, filename, exiftool=None, exif_data=None):
+        # Exif may have already been loaded as part of a batch of files
+        if exif_data:
+            self.exif_data = exif_data
+        else:
+            self.load_exif(exiftool)
 
         logger.debug(f'Getting date taken for {filename}')
         try:
@@ -74,14 +78,18 @@ class Image(object):
             logger.debug(f'opening raw file: {filename}')
             self.img = PIL_Image.open(BytesIO(raw.extract_thumb().data))
 
-    def load_exif(self):
-        with ExifTool() as e:
-            logger.debug(f'sending {self.filename} to exiftool')
-            try:
-                self.exif_data = e.get_metadata(self.filename)
-                logger.debug(f'successfully loaded exif on {self.filename}')
-            except:
-                logger.error(f'error loading exif on {self.filename}')
+    def load_exif(self, exiftool=None):
+        # Without a shared exiftool (or pool of them) start one up just for this file
+        if not exiftool:
+            with ExifTool() as e:
+                return self.load_exif(e)
+
+        logger.debug(f'sending {self.filename} to exiftool')
+        try:
+            self.exif_data = exiftool.get_metadata(self.filename)[0]
+            logger.debug(f'successfully loaded exif on {self.filename}')
+        except:
+            logger.error(f'error loading exif on {self.filename}')
 
 
     def get_exif(self):
@@ -110,10 +118,14 @@ class Image(object):
         self.img.thumbnail((long_edge_size,long_edge_size))
         buffered = BytesIO()
         self.img.save(buffered, format="JPEG")
-        result = base64.b64encode(buffered.getvalue()).decode('utf-8')
+        result = buffered.getvalue()
         logger.debug(f'generated thumbnail for {self.filename}')
         return result
 
+    def get_thumbnails(self, long_edge_sizes=(512, 256, 128, 64)):
+        # Largest first, each one is shrunk from the last so the full image is only resized once
+        return {size: self.get_thumbnail(size) for size in sorted(long_edge_sizes, reverse=True)}
+
     def get_fingerprint(self):
         logger.debug(f'generating fingerprint for {self.filename}')
         # Blur, resize, greyscale, autocontrast
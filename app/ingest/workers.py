@@ -1,47 +1,154 @@
 from config import config
 
+import multiprocessing
 import os
 from ingest.image import Image
+from ingest.exiftool import ExifTool, ExifToolPool
 
-from processed_images.processed_images import LockingProcessedImages, ProcessedImages, QueueingProcessedImages, ProcessedImage
+from processed_images.processed_images import QueueingProcessedImages, ProcessedImage
 
-from threading import Lock
+from threading import Thread
 from queue import Queue
-from concurrent.futures import ThreadPoolExecutor, wait, ALL_COMPLETED
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from datetime import datetime
+from multiprocessing.util import Finalize
+from contextlib import nullcontext
 
 import logging
 logger = logging.getLogger(__name__)
 
 
+
+# Each process in the process pool engine keeps its own exiftool open for the life of the pool
+process_exiftool = None
+
+def init_process_worker(exiftool_timeout=None):
+    global process_exiftool
+    process_exiftool = ExifTool(timeout=exiftool_timeout)
+    process_exiftool.start()
+    # atexit isn't run in pool processes, multiprocessing finalizers are
+    Finalize(process_exiftool, process_exiftool.stop, exitpriority=10)
+
+
+def load_exif_batch(image_files, exiftool):
+    # One exiftool call for the whole batch, then match each result back up to its file
+    logger.debug(f'sending batch of {len(image_files)} files to exiftool')
+    try:
+        results = exiftool.get_metadata(*image_files)
+    except Exception as e:
+        logger.error(f'error loading exif for batch starting at {image_files[0]}, falling back to single files: {e}')
+        return {}
+
+    return {r['SourceFile']: r for r in results if 'SourceFile' in r}
+
+
+def get_file_stat(filename):
+    # What's stored in the manifest to tell if a file has changed since it was processed
+    stat = os.stat(filename)
+    return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+
+def load_image_batch(image_files, exiftool=None, thumbnail_sizes=(512, 256, 128, 64)):
+    """
+    Load exif, date and thumbnail for a batch of files. This runs in either a thread or a
+    separate process so it never touches the database, it returns a compact tuple per file:
+        (filename, filetype, date_taken timestamp, exif_data, {size: thumbnail}, (file_size, file_mtime, file_inode))
+    Files that fail to load come back with everything but the filename set to None.
+    """
+    if not exiftool:
+        exiftool = process_exiftool
+        # Killed after a timeout, or crashed, on an earlier batch
+        if not exiftool.is_running():
+            logger.warning('exiftool process exited, starting a new one')
+            try:
+                exiftool.start()
+            except Exception as e:
+                logger.error(f'unable to start exiftool: {e}')
+    exif_batch = load_exif_batch(image_files, exiftool)
+
+    results = []
+    for image_file in image_files:
+        logger.info(f'Processing {image_file}')
+        try:
+            # Stat before reading so a change made while we're reading it is picked up next time
+            file_stat = get_file_stat(image_file)
+            image = Image(image_file, exiftool=exiftool, exif_data=exif_batch.get(image_file))
+            results.append((
+                image_file,
+                image.filetype,
+                int(image.get_photo_date().timestamp()),
+                image.get_json_safe_exif(),
+                image.get_thumbnails(thumbnail_sizes),
+                file_stat
+            ))
+        except Exception as e:
+            logger.error(f'Exception during image processing {image_file}: {e}')
+            results.append((image_file, None, None, None, None, None))
+    return results
+
+
 class DirectoryWorker(object):
     def __init__(
         self,
-        processed_images=LockingProcessedImages(db_dir=config['photo_database']['database_dir']),
-        file_types=['.CR2', '.CR3', '.JPG']
+        processed_images=None,
+        file_types=['.CR2', '.CR3', '.JPG'],
+        threads=None,
+        batch_size=64,
+        engine='thread',
+        thumbnail_sizes=(512, 256, 128, 64)
     ):
-        self.processed_images = processed_images
+        # Same default as ThreadPoolExecutor, we need to know it to size the exiftool pool to match
+        self.threads = threads or min(32, (os.cpu_count() or 1) + 4)
+        self.batch_size = batch_size
+        self.thumbnail_sizes = thumbnail_sizes
+        self.exiftool_timeout = config['ingest'].getint('exiftool_timeout', fallback=None)
+
+        # Bounds on each stage of the scan pipeline, so memory stays flat however many files there are.
+        # Enough batches queued to keep every worker busy while the next ones are walked,
+        # and roughly one batch per worker waiting on the database writer.
+        self.max_pending_batches = self.threads * 2
+
+        # All database writes go through the queue's single writer thread, whichever engine is used
+        self.processed_images = processed_images or QueueingProcessedImages(
+            db_dir=config['photo_database']['database_dir'],
+            max_queue_size=self.threads * batch_size,
+            write_batch_size=config['photo_database'].getint('write_batch_size'),
+            write_batch_time=config['photo_database'].getint('write_batch_ms') / 1000
+        )
         self.file_types = file_types
-        self.found_files = []
+        self.directories = []
+        self.total_files = 0
+        self.walk_errors = 0
+
+        if engine not in ['thread', 'process']:
+            raise Exception(f"Unknown ingest engine {engine}, use 'thread' or 'process'")
+        self.engine = engine
     
-    def get_image_files(self, base_dir, file_types=None):
+    def walk_image_files(self, base_dir, file_types=None):
+        # Yield files as they're found so processing can start before the whole tree has been walked
         logger.debug(f'finding files in {base_dir}')
         if not file_types:
             file_types = self.file_types
 
-        previous_count = self.get_total_files()
-        for root, _, files in os.walk(base_dir, topdown = False):
-            for name in files:
-                fullpath = os.path.join(root, name)
-                if os.path.splitext(fullpath)[-1].upper() in file_types:
-                    self.found_files.append(fullpath)
-        logger.info(f'found {len(self.found_files)-previous_count} in {base_dir}')
-        return self.found_files
+        found_count = 0
+        def walk_error(e):
+            logger.error(f'unable to walk {e.filename}: {e}')
+            self.walk_errors += 1
+
+        for root, dirs, files in os.walk(base_dir, onerror=walk_error):
+            dirs.sort()
+            for name in sorted(files):
+                if os.path.splitext(name)[-1].upper() in file_types:
+                    found_count += 1
+                    yield os.path.join(root, name)
+        logger.info(f'found {found_count} in {base_dir}')
 
     def set_directory(self, directory):
-        self.get_image_files(directory)
+        self.directories.append(directory)
 
     def get_total_files(self):
-        return len(self.found_files)
+        # Files found so far, this only reaches the final total once the scan has walked everything
+        return self.total_files
 
     def dummy_callback(self, image_file, state):
         logger.debug(f'dummy callback: {image_file}, {state}')
@@ -50,67 +157,165 @@ class DirectoryWorker(object):
         logger.debug('stop worker')
         self.processed_images.stop()
 
+    def walk_thread(self, batch_queue, reprocess, processed_file_callback):
+        # Walk stage: find files, skip ones that haven't changed since they were processed and group the rest
+        # into batches. Blocks on the bounded batch queue whenever the decode stage falls behind.
+        try:
+            manifest = self.processed_images.get_file_manifest()
+            logger.info(f'{len(manifest)} files already processed')
+            # Files processed before sizes and times were recorded, assumed unchanged and filled in at the end
+            legacy_file_stats = []
+
+            batch = []
+            for directory in self.directories:
+                for image_file in self.walk_image_files(directory):
+                    self.total_files += 1
+                    # Whatever is left in the manifest after the walk has been deleted
+                    known = manifest.pop(image_file, None)
+
+                    if known and not reprocess:
+                        try:
+                            file_stat = get_file_stat(image_file)
+                        except OSError as e:
+                            logger.error(f'unable to stat {image_file}: {e}')
+                            continue
+
+                        file_size, file_mtime, file_inode, deleted = known
+                        if file_size is None and not deleted:
+                            legacy_file_stats.append(file_stat + (image_file, ))
+                            unchanged = True
+                        else:
+                            unchanged = not deleted and (file_size, file_mtime, file_inode) == file_stat
+
+                        if unchanged:
+                            logger.debug(f'already processed {image_file}')
+                            processed_file_callback(image_file, 'already_processed')
+                            continue
+                        logger.info(f'{image_file} is new or has changed since it was processed')
+
+                    batch.append(image_file)
+                    if len(batch) >= self.batch_size:
+                        batch_queue.put(batch)
+                        batch = []
+            if batch:
+                batch_queue.put(batch)
+
+            if legacy_file_stats:
+                self.processed_images.set_file_stats(legacy_file_stats)
+
+            self.mark_deleted_files(manifest)
+        except Exception as e:
+            logger.error(f'Exception while walking directories: {e}')
+            self.walk_exception = e
+        finally:
+            batch_queue.put(None)
+
+    def mark_deleted_files(self, unseen_files):
+        # A directory we couldn't read would look like everything in it had been deleted
+        if self.walk_errors:
+            logger.warning(f'{self.walk_errors} errors walking directories, not marking any files as deleted')
+            return
+
+        base_dirs = tuple(os.path.join(directory, '') for directory in self.directories)
+        deleted_files = [
+            filename for filename, (_, _, _, deleted) in unseen_files.items()
+            if not deleted and filename.startswith(base_dirs)
+        ]
+        if deleted_files:
+            logger.info(f'{len(deleted_files)} files have been deleted since they were processed')
+            self.processed_images.mark_deleted(deleted_files)
+
     def scan(self, reprocess=False, processed_file_callback=None):
         logger.info('Starting scan')
         self.processed_images.start()
         if not processed_file_callback:
             processed_file_callback = self.dummy_callback
 
-        logger.info('Creating thread pool executor')
-        with ThreadPoolExecutor() as executor:
-            results = [
-                executor.submit(
-                    self.process_single_image_thread,
-                    image_file=image_file, 
-                    reprocess=reprocess, 
-                    processed_file_callback=processed_file_callback
-                )
-                for image_file in self.found_files
-            ]
-            # I need to check for bad results in all of these:
-            logger.info('Waiting for all threads to finish')
-            wait(results, return_when=ALL_COMPLETED)
-
-            # If we don't do this the tread might result in an exception which is never shown.
-            # But looking at each result we cause the Exception to be displayed at least.
-            for result in results:
-                if result.result():
-                    logger.debug(f'Thread result: {result.result()}')
+        self.total_files = 0
+        self.walk_errors = 0
+        self.walk_exception = None
+        batch_queue = Queue(maxsize=self.max_pending_batches)
+        walker = Thread(target=self.walk_thread, args=(batch_queue, reprocess, processed_file_callback), daemon=True)
+        walker.start()
+
+        logger.info(f'Creating {self.engine} pool with {self.threads} workers')
+        with self.get_exiftool_pool() as exiftool, self.get_executor() as executor:
+            # Decode stage: at most max_pending_batches are in the pool at once, when it's full we wait
+            # for some to finish before taking more from the walker.
+            # Results are handled here as they complete, so only this thread hands metadata to processed images,
+            # whose bounded queue in turn holds this thread up if the database writer falls behind.
+            # Looking at each result also causes any Exception in the workers to be raised rather than never shown.
+            pending = set()
+            while True:
+                batch = batch_queue.get()
+                if batch is None:
+                    break
 
+                pending.add(executor.submit(load_image_batch, batch, exiftool, self.thumbnail_sizes))
+                if len(pending) >= self.max_pending_batches:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for result in done:
+                        self.add_image_batch(result.result(), processed_file_callback)
+
+            logger.info('Waiting for remaining batches to finish')
+            for result in as_completed(pending):
+                self.add_image_batch(result.result(), processed_file_callback)
+
+            if exiftool:
+                logger.info(f'exiftool stats: {exiftool.get_stats()}')
+
+        walker.join()
         processed_file_callback('All', 'done')
         self.processed_images.stop()
-        logger.info('Finished scan')
 
-    def process_single_image_thread(self, image_file, reprocess, processed_file_callback):
-        processed_file_callback(image_file, 'start')
+        if self.walk_exception:
+            raise self.walk_exception
+        logger.info(f'Finished scan of {self.total_files} files')
 
-        if self.processed_images.check_if_processed(image_file) and not reprocess:
-            logger.debug(f'already processed {image_file}')
-            processed_file_callback(image_file, 'already_processed')
-            return
+    def get_exiftool_pool(self):
+        # Processes can't share exiftools with this one, they start their own in init_process_worker
+        if self.engine == 'process':
+            return nullcontext()
+        return ExifToolPool(self.threads, timeout=self.exiftool_timeout)
 
-        logger.info(f'Processing {image_file}')
-        try:
-            image = Image(image_file)
-        except Exception as e:
-            logger.error(f'Exception during image processing {e}')
-            processed_file_callback(image_file, 'error')
-            return None    
-
-        metadata = ProcessedImage(
-            filename=image_file,
-            filetype=image.filetype,
-            date_taken=image.get_photo_date(),
-            exif_data = image.get_json_safe_exif(),
-            thumbnail=image.get_thumbnail(),
-            latitude=None,
-            longitude=None
-        )
+    def get_executor(self):
+        if self.engine == 'process':
+            # Not forked, by now the walker and database writer threads are running and a fork could copy a lock
+            # (logging's, say) one of them holds, leaving the child waiting on it forever
+            return ProcessPoolExecutor(
+                max_workers=self.threads,
+                mp_context=multiprocessing.get_context('forkserver'),
+                initializer=init_process_worker,
+                initargs=(self.exiftool_timeout, )
+            )
+        return ThreadPoolExecutor(max_workers=self.threads)
+
+    def add_image_batch(self, image_batch, processed_file_callback):
+        for image_file, filetype, date_taken, exif_data, thumbnails, file_stat in image_batch:
+            processed_file_callback(image_file, 'start')
+
+            if not filetype:
+                processed_file_callback(image_file, 'error')
+                continue
+
+            metadata = ProcessedImage(
+                filename=image_file,
+                filetype=filetype,
+                date_taken=datetime.fromtimestamp(date_taken),
+                exif_data=exif_data,
+                thumbnail=thumbnails[max(thumbnails)],
+                thumbnails=thumbnails,
+                latitude=None,
+                longitude=None,
+                file_size=file_stat[0],
+                file_mtime=file_stat[1],
+                file_inode=file_stat[2]
+            )
 
-        logger.info(f'Sending {image_file} metadata to processed images')
-        self.processed_images.add(metadata)
+            logger.info(f'Sending {image_file} metadata to processed images')
+            self.processed_images.add(metadata)
 
-        processed_file_callback(image_file, 'end')
+            processed_file_callback(image_file, 'end')
 
 
 class MultiDirectoryWorker(DirectoryWorker):
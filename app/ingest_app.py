@@ -13,46 +13,44 @@ from ingest.workers import MultiDirectoryWorker
 
 import os
 
-from progress.bar import Bar
+from progress.counter import Counter
 
 from threading import Lock
 
 class Display():
-    def __init__(self, total_images, progress_bar=True):
+    def __init__(self, progress_bar=True):
+        # Files are processed while the directories are still being walked, so there's no total to count down from
         self.count = 0
-        self.total_images = total_images
-        self.average_image_time = 1
+        # Files are handed over a batch at a time once they've been processed, so there's no time per file to show,
+        # only how many have been processed a second since the scan started
+        self.start_time = time.time()
         self.lock = Lock()
 
+        self.progress = None
         if progress_bar:
-            self.progress = Bar('Processing images', width=110, max=total_images, suffix='%(index)d/%(max)d - %(eta)ds')
+            self.progress = Counter('Processed images: ')
 
 
     def display_callback(self, image_file, state):
         # Make this add to a queue, then separate the display out in to it's own thread
         with self.lock:
-            if state == 'start':
-                self.start_time = time.time()
-                self.count = self.count + 1
-            elif state == 'already_processed':
+            if state == 'already_processed':
                 if self.progress:
                     self.progress.next()
                 else:
                     print(f'Already processed {image_file} previously, skipping')
             elif state == 'end':
-                self.end_time = time.time()
-                self.average_image_time = (self.average_image_time + (self.end_time - self.start_time)) / 2
-                images_left = self.total_images - self.count
-                time_left = timedelta(seconds=self.average_image_time * images_left)
-        
+                self.count = self.count + 1
+
                 if self.progress:
                     self.progress.next()
                 else:
+                    elapsed = time.time() - self.start_time
                     print(f"Finished processing {image_file}")
-                    print("Time on image: ", self.end_time-self.start_time)
-                    print(f"Approximate time left: {time_left}")
+                    print(f"Processed {self.count} images in {timedelta(seconds=int(elapsed))}, {self.count / max(elapsed, 0.001):.1f} per second")
             elif state == 'done':
-                self.progress.finish()
+                if self.progress:
+                    self.progress.finish()
                 # Monitor queue size?
                 print('waiting for queue to empty...')
 
@@ -67,23 +65,24 @@ if __name__ == '__main__':
     logger = logging.getLogger(__name__)
 
     logger.debug('Creating worker object')
-    w = MultiDirectoryWorker()
+    w = MultiDirectoryWorker(
+        threads=config['ingest'].getint('threads') or None,
+        batch_size=config['ingest'].getint('exif_batch_size'),
+        engine=config['ingest']['engine'],
+        thumbnail_sizes=[int(size) for size in config['ingest']['thumbnail_sizes'].split(',')]
+    )
 
     # Get list of paths from section in config file, but exclude default keys (including the base path...)
     paths = [ v for k,v in config['ingest_paths'].items() if k not in config['DEFAULT'].keys()]
     logging.debug(f'Setting paths to process: {paths}')
-    print('Scanning directories for files...')
     w.set_directory(paths)
 
-    total_files = w.get_total_files()
-    logging.info(f'total files to process {total_files}')
-
     logging.debug('creating display object')
-    d = Display(total_files, progress_bar=config['ingest'].getboolean('progress_bar'))
+    d = Display(progress_bar=config['ingest'].getboolean('progress_bar'))
     reprocess = config['ingest'].getboolean('reingest')
 
     logging.info(f'reprocessing of files set to {reprocess}')
     logging.debug('starting scan of paths')
     w.scan(reprocess=reprocess, processed_file_callback=d.display_callback)
-    logging.debug('finished scanning all files')
+    logging.info(f'finished scanning all {w.get_total_files()} files')
     print('')
\ No newline at end of file
@@ -0,0 +1,50 @@
+# Compare the thread and process ingest engines on a local folder of sample images, eg:
+#   python ingest_benchmark.py /work/stash/Photos/samples --workers 24
+# Each engine ingests everything in to its own throwaway database so nothing is skipped as already processed.
+
+from config import config
+
+import argparse
+import logging
+import tempfile
+import time
+
+from ingest.workers import DirectoryWorker
+from processed_images.processed_images import QueueingProcessedImages
+
+logger = logging.getLogger(__name__)
+
+
+def benchmark_engine(engine, sample_dir, workers, batch_size):
+    with tempfile.TemporaryDirectory() as db_dir:
+        w = DirectoryWorker(
+            processed_images=QueueingProcessedImages(db_dir=db_dir),
+            threads=workers,
+            batch_size=batch_size,
+            engine=engine
+        )
+        w.set_directory(sample_dir)
+
+        start = time.time()
+        w.scan(reprocess=True)
+        elapsed = time.time() - start
+        total_files = w.get_total_files()
+
+    return total_files, elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the ingest engines against a folder of sample images')
+    parser.add_argument('sample_dir')
+    parser.add_argument('--workers', type=int, default=config['ingest'].getint('threads') or None)
+    parser.add_argument('--batch-size', type=int, default=config['ingest'].getint('exif_batch_size'))
+    parser.add_argument('--engines', nargs='+', default=['thread', 'process'])
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    for engine in args.engines:
+        total_files, elapsed = benchmark_engine(engine, args.sample_dir, args.workers, args.batch_size)
+        per_image = elapsed / total_files if total_files else 0
+        rate = total_files / elapsed if elapsed else 0
+        print(f'{engine:>8}: {total_files} images in {elapsed:.1f}s, {per_image:.3f}s per image, {rate:.1f} images/s')
@@ -0,0 +1,77 @@
+import json
+import re
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def iter_json_array(f, key, chunk_size=1 << 20, max_item_chunks=4):
+    """
+    Yield each item in the array under "key": [...] of a JSON text file, reading it a chunk at a time.
+    Memory use is a couple of chunks plus one item, however big the file is.
+    The first array with that key is used, wherever it is in the file.
+    An item that still doesn't decode once max_item_chunks chunks of it have been read is taken to be invalid,
+    rather than reading the rest of the file in to memory looking for its end.
+    """
+    decoder = json.JSONDecoder()
+    key_pattern = re.compile(r'"' + re.escape(key) + r'"\s*:\s*\[')
+    separator_pattern = re.compile(r'[\s,]*')
+
+    # Find the start of the array, keeping the end of the previous chunk in case the key is split between two
+    buffer = ''
+    # Characters read from the file so far, for where errors are
+    read = 0
+    while True:
+        match = key_pattern.search(buffer)
+        if match:
+            buffer = buffer[match.end():]
+            break
+
+        chunk = f.read(chunk_size)
+        read += len(chunk)
+        if not chunk:
+            logger.warning(f'no "{key}" array found')
+            return
+        buffer = buffer[-(len(key) + 64):] + chunk
+
+    position = 0
+    end_of_file = False
+    count = 0
+    while True:
+        position = separator_pattern.match(buffer, position).end()
+        if position >= len(buffer):
+            if end_of_file:
+                raise ValueError(f'end of file inside the "{key}" array')
+            chunk = f.read(chunk_size)
+            read += len(chunk)
+            end_of_file = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+
+        if buffer[position] == ']':
+            logger.debug(f'read {count} items from the "{key}" array')
+            return
+
+        try:
+            item, position = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError as e:
+            # Most likely the item carries on in to the next chunk, unless it's already longer than any item should be
+            if end_of_file or len(buffer) - position > max_item_chunks * chunk_size:
+                raise ValueError(
+                    f'invalid item at character {read - len(buffer) + position} in the "{key}" array: {e.msg}'
+                ) from e
+            chunk = f.read(chunk_size)
+            read += len(chunk)
+            end_of_file = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+
+        count += 1
+        yield item
+
+        # Drop what's been read once it's worth the copy
+        if position > chunk_size:
+            buffer = buffer[position:]
+            position = 0
@@ -0,0 +1,199 @@
+import numpy as np
+import os
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class LocationIndex(object):
+    """
+    Location history held as sorted arrays, saved to .npy files and memory mapped back in:
+        timestamps - int64 epoch milliseconds, sorted
+        lat, lng - int32 degrees * 1e7
+        accuracy - int32 metres, -1 if unknown
+    Lookups for any number of timestamps are a single searchsorted over the timestamps.
+    """
+    columns = {
+        'timestamps': np.int64,
+        'lat': np.int32,
+        'lng': np.int32,
+        'accuracy': np.int32
+    }
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        self.arrays = None
+        # Points that pass each accuracy threshold asked for so far
+        self.usable = {}
+
+    def _path(self, column, suffix=''):
+        return self.index_dir + os.sep + column + suffix + '.npy'
+
+    def exists(self):
+        return all(os.path.exists(self._path(column)) for column in self.columns)
+
+    @staticmethod
+    def _to_columns(rows):
+        # (timestamp seconds, lat, lng, accuracy) rows to index columns
+        chunk = np.array(rows, dtype=np.float64).reshape(-1, 4)
+        # Some Google exports have coordinates that have overflowed a signed 32 bit int
+        chunk[:, 1] = np.where(chunk[:, 1] > 900000000, chunk[:, 1] - 4294967296, chunk[:, 1])
+        chunk[:, 2] = np.where(chunk[:, 2] > 1800000000, chunk[:, 2] - 4294967296, chunk[:, 2])
+        return {
+            'timestamps': np.rint(chunk[:, 0] * 1000).astype(np.int64),
+            'lat': chunk[:, 1].astype(np.int32),
+            'lng': chunk[:, 2].astype(np.int32),
+            'accuracy': chunk[:, 3].astype(np.int32)
+        }
+
+    @staticmethod
+    def _first_at_each_timestamp(timestamps, previous_timestamp=None):
+        # Points are sorted best first within each timestamp, so duplicates are everything after the first
+        keep = np.empty(len(timestamps), dtype=bool)
+        if len(timestamps):
+            keep[0] = timestamps[0] != previous_timestamp
+            keep[1:] = timestamps[1:] != timestamps[:-1]
+        return keep
+
+    def _replace(self, write):
+        # Build in to temporary files and swap them in at the end, so readers never see half an index
+        os.makedirs(self.index_dir, exist_ok=True)
+        self.arrays = None
+        self.usable = {}
+
+        write(lambda column: self._path(column, '.tmp'))
+        for column in self.columns:
+            os.replace(self._path(column, '.tmp'), self._path(column))
+
+    def build(self, cursor, count, chunk_size=100000):
+        """
+        Write the index from a cursor of (timestamp seconds, lat, lng, accuracy) rows, ordered by timestamp
+        and then best accuracy first. Only the most accurate point is kept where several share a timestamp.
+        Rows are copied a chunk at a time straight into the files, so memory use doesn't depend on count.
+        """
+        logger.info(f'Building location index of {count} points in {self.index_dir}')
+
+        def write(path):
+            arrays = {
+                column: np.lib.format.open_memmap(self._path(column, '.build'), mode='w+', dtype=dtype, shape=(count, ))
+                for column, dtype in self.columns.items()
+            }
+
+            position = 0
+            previous_timestamp = None
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                chunk = self._to_columns(rows)
+                keep = self._first_at_each_timestamp(chunk['timestamps'], previous_timestamp)
+                previous_timestamp = chunk['timestamps'][-1]
+
+                end = position + np.count_nonzero(keep)
+                for column, array in arrays.items():
+                    array[position:end] = chunk[column][keep]
+                position = end
+
+            # Without the space left at the end by any duplicates
+            for column, array in arrays.items():
+                np.save(path(column), array[:position])
+            arrays = None
+            for column in self.columns:
+                os.remove(self._path(column, '.build'))
+            logger.info(f'Location index built with {position} points, {count - position} duplicates removed')
+
+        self._replace(write)
+
+    def merge(self, cursor, chunk_size=100000):
+        """
+        Add a cursor of (timestamp seconds, lat, lng, accuracy) rows to the index without rebuilding it from the database.
+        Where a new point has the same timestamp as an existing one the more accurate one is kept.
+        """
+        chunks = []
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            chunks.append(self._to_columns(rows))
+        if not chunks:
+            return
+        new = {column: np.concatenate([chunk[column] for chunk in chunks]) for column in self.columns}
+        chunks = None
+
+        existing = self.load() if self.exists() else {column: np.empty(0, dtype) for column, dtype in self.columns.items()}
+        merged = {column: np.concatenate([existing[column], new[column]]) for column in self.columns}
+        existing = None
+
+        # Sort by timestamp, then known accuracies before unknown ones, then best accuracy first
+        order = np.lexsort((merged['accuracy'], merged['accuracy'] < 0, merged['timestamps']))
+        merged = {column: array[order] for column, array in merged.items()}
+        keep = self._first_at_each_timestamp(merged['timestamps'])
+
+        logger.info(f'Merging {len(new["timestamps"])} points in to location index, {len(keep) - np.count_nonzero(keep)} duplicates removed')
+
+        def write(path):
+            for column, array in merged.items():
+                np.save(path(column), array[keep])
+        self._replace(write)
+
+    def load(self):
+        if self.arrays is None:
+            logger.debug(f'Memory mapping location index from {self.index_dir}')
+            self.arrays = {column: np.load(self._path(column), mmap_mode='r') for column in self.columns}
+        return self.arrays
+
+    def __len__(self):
+        return len(self.load()['timestamps'])
+
+    def _usable_points(self, max_accuracy):
+        # Points accurate to within max_accuracy metres, unknown accuracy is given the benefit of the doubt
+        if max_accuracy not in self.usable:
+            arrays = self.load()
+            if max_accuracy is None:
+                keep = slice(None)
+            else:
+                keep = np.flatnonzero(arrays['accuracy'] <= max_accuracy)
+                logger.info(f'{len(arrays["accuracy"]) - len(keep)} of {len(arrays["accuracy"])} locations are less accurate than {max_accuracy}m, ignoring them')
+            self.usable[max_accuracy] = (arrays['timestamps'][keep], arrays['lat'][keep], arrays['lng'][keep])
+        return self.usable[max_accuracy]
+
+    def lookup(self, timestamps, max_accuracy=None, max_gap=None):
+        """
+        Location for each of an array of epoch second timestamps, as two float arrays of lat and lng in degrees.
+        Points less accurate than max_accuracy metres are ignored. The location is interpolated by time between
+        the points either side of the timestamp, or is the nearest point if only one of them is within max_gap
+        seconds. If neither is, there's no location (NaN).
+        """
+        index_timestamps, index_lat, index_lng = self._usable_points(max_accuracy)
+        t = np.rint(np.asarray(timestamps, dtype=np.float64) * 1000).astype(np.int64)
+
+        lat = np.full(t.shape, np.nan)
+        lng = np.full(t.shape, np.nan)
+        if len(index_timestamps) == 0:
+            return lat, lng
+
+        # Last point at or before, and first point at or after, each timestamp
+        before = np.searchsorted(index_timestamps, t, side='right') - 1
+        after = before + 1
+        has_before = before >= 0
+        has_after = after < len(index_timestamps)
+        before = np.clip(before, 0, len(index_timestamps) - 1)
+        after = np.clip(after, 0, len(index_timestamps) - 1)
+
+        time_before = index_timestamps[before]
+        time_after = index_timestamps[after]
+        if max_gap is not None:
+            has_before &= (t - time_before) <= max_gap * 1000
+            has_after &= (time_after - t) <= max_gap * 1000
+
+        # How far along from the point before to the point after, 0 uses just the point before and 1 the point after
+        span = (time_after - time_before).astype(np.float64)
+        weight = np.divide(t - time_before, span, out=np.zeros(t.shape), where=span > 0)
+        weight = np.where(has_before & has_after, weight, np.where(has_after, 1.0, 0.0))
+
+        found = has_before | has_after
+        lat_before, lat_after = index_lat[before].astype(np.float64), index_lat[after].astype(np.float64)
+        lng_before, lng_after = index_lng[before].astype(np.float64), index_lng[after].astype(np.float64)
+        lat[found] = ((lat_before + (lat_after - lat_before) * weight) / 1e7)[found]
+        lng[found] = ((lng_before + (lng_after - lng_before) * weight) / 1e7)[found]
+        return lat, lng
@@ -1,12 +1,17 @@
 from geopy.geocoders import Nominatim
 from geopy.extra.rate_limiter import RateLimiter
-import json
 from datetime import datetime
 import sqlite3
 import os
+import math
+import hashlib
 
 from threading import Lock
 
+from locations.location_index import LocationIndex
+from locations.sources import GoogleHistorySource
+from itertools import islice
+
 import logging
 logger = logging.getLogger(__name__)
 
@@ -25,7 +30,10 @@ class Locations:
             "accuracy" : 1046
         },
     """
-    def __init__(self, history_file=None, history_db_dir=None, enable_geopy=False, reload=False):
+    # Locations are parsed and inserted this many at a time
+    insert_chunk_size = 50000
+
+    def __init__(self, history_file=None, history_db_dir=None, enable_geopy=False, reload=False, max_accuracy=None, max_gap=None):
         self.location_database_name = history_db_dir + os.sep + 'locations.db'
 
         logger.info(f'Opening location database {self.location_database_name}')
@@ -33,11 +41,24 @@ class Locations:
         self.cursor = self.conn.cursor()
         self.lock = Lock()
 
+        self.index = LocationIndex(history_db_dir + os.sep + 'location_index')
+        # Ignore points less accurate than max_accuracy metres, and don't match photos more than max_gap seconds from a point
+        self.max_accuracy = max_accuracy
+        self.max_gap = max_gap
+
+        self.create_tables()
+
         if reload:
-            logger.debug(f'checking if database is current')
-            if not self.check_database_current(history_file):
-                logger.warning(f'database is out of date with {history_file}, reloading')
-                self.load_json_data(history_file)
+            # Locations loaded before sources were recorded all came from the history file
+            self.cursor.execute('UPDATE locations SET source = ? WHERE source IS NULL', (history_file, ))
+            self.conn.commit()
+
+            # Only the points added to the file since it was last loaded are inserted
+            self.load_json_data(history_file)
+
+        if not self.index.exists():
+            logger.warning('location index is missing, building it from the location database')
+            self.build_index()
 
         self.enable_geopy = enable_geopy
         if self.enable_geopy:
@@ -55,83 +76,181 @@ class Locations:
                 timestamp INTEGER,
                 lat INTEGER,
                 lng INTEGER, 
-                accuracy INTEGER
+                accuracy INTEGER,
+                source TEXT
             );
-            CREATE TABLE IF NOT EXISTS historytimestamp (
-                timestamp INTEGER
+            CREATE TABLE IF NOT EXISTS sources (
+                filename TEXT NOT NULL PRIMARY KEY,
+                size INTEGER,
+                mtime INTEGER,
+                points INTEGER,
+                checksum TEXT,
+                last_timestamp REAL
             );
             CREATE INDEX IF NOT EXISTS locations_idx ON locations ( timestamp );
         ''')
 
-    def check_database_current(self, filename):
-        self.cursor.execute('SELECT timestamp from historytimestamp;')
+        # Locations loaded before there were multiple sources
+        columns = [r[1] for r in self.cursor.execute('PRAGMA table_info(locations)')]
+        if 'source' not in columns:
+            logger.info('Adding source column to locations')
+            self.cursor.execute('ALTER TABLE locations ADD COLUMN source TEXT')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS locations_source_idx ON locations ( source );')
+
+        columns = [r[1] for r in self.cursor.execute('PRAGMA table_info(sources)')]
+        for column, column_type in [('checksum', 'TEXT'), ('last_timestamp', 'REAL')]:
+            if column not in columns:
+                logger.info(f'Adding {column} column to sources')
+                self.cursor.execute(f'ALTER TABLE sources ADD COLUMN {column} {column_type}')
+        self.conn.commit()
+
+    @staticmethod
+    def _file_checksum(filename, chunk_size=1 << 20):
+        h = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def _source_state(self, filename):
+        # The stored state of a source, and its checksum if it had to be worked out. None for a source never loaded.
+        self.cursor.execute('SELECT size, mtime, checksum, points, last_timestamp FROM sources WHERE filename = ?', (filename, ))
         r = self.cursor.fetchone()
+        stat = os.stat(filename)
 
-        history_file_version = int(os.stat(filename).st_ctime)
-        logger.debug(f'database version = {r[0]}, history file version = {history_file_version}')
+        # Same size and mtime is taken as unchanged, without reading the file
+        if r and (r[0], r[1]) == (stat.st_size, stat.st_mtime_ns):
+            return r, stat, r[2]
+        return r, stat, self._file_checksum(filename)
 
-        if r and r[0] == history_file_version:
-            return True
-        return False
+    def check_database_current(self, filename):
+        self.create_tables()
+        r, stat, checksum = self._source_state(filename)
+        logger.debug(f'database checksum = {r[2] if r else None}, {filename} checksum = {checksum}')
+        return r is not None and r[2] == checksum
 
-    def load_json_data(self, jsonfile):
-        # Get a lock if we're loading everything in
-        with self.lock:
-            self.create_tables()
-            logger.debug('delete all data')
-            self.cursor.execute('DELETE FROM locations')
-            self.cursor.execute('DELETE FROM historytimestamp')
-            self.cursor.execute('INSERT INTO historytimestamp VALUES (?)', (int(os.stat(jsonfile).st_ctime), ))
+    def _insert_points(self, points, source, after=None):
+        # Parsed and inserted a chunk at a time, history files can be gigabytes.
+        # Points at or before after are counted but not inserted.
+        inserted = 0
+        skipped = 0
+        last_timestamp = after
+        while True:
+            chunk = list(islice(points, self.insert_chunk_size))
+            if not chunk:
+                break
+            rows = [point + (source, ) for point in chunk if after is None or point[0] > after]
+            skipped += len(chunk) - len(rows)
+            if rows:
+                self.cursor.executemany('INSERT INTO locations VALUES(?, ?, ?, ?, ?);', rows)
+                inserted += len(rows)
+                chunk_last = max(row[0] for row in rows)
+                last_timestamp = chunk_last if last_timestamp is None else max(last_timestamp, chunk_last)
+            logger.debug(f'{inserted} locations inserted from {source}')
+        return inserted, skipped, last_timestamp
 
-            logger.info(f'load data from {jsonfile}')
-            with open(jsonfile) as f:
-                locations=json.load(f)
+    def _load_source(self, source):
+        """
+        Bring the rows for one source up to date with its file. Returns None if nothing changed,
+        the timestamp after which new rows were appended (None for all of them), or False if
+        existing rows were replaced and the index has to be rebuilt.
+        """
+        r, stat, checksum = self._source_state(source.filename)
+        if r and r[2] == checksum:
+            logger.debug(f'{source.filename} has not changed since it was loaded')
+            if (r[0], r[1]) != (stat.st_size, stat.st_mtime_ns):
+                self.cursor.execute('UPDATE sources SET size = ?, mtime = ? WHERE filename = ?', (stat.st_size, stat.st_mtime_ns, source.filename))
+                self.conn.commit()
+            return None
 
-            for l in locations['locations']:
-                timestamp = int(l['timestampMs']) / 1000
-                lat = l['latitudeE7']
-                lng = l['longitudeE7']
-                accuracy = l['accuracy'] if 'accuracy' in l else -1
+        if r and r[2] is not None and r[4] is not None:
+            # Exports only ever grow at the end, so try adding just the points after the last one loaded.
+            # If the points up to there aren't the ones already loaded, history has been edited and it's a full reload.
+            logger.info(f'{source.filename} has changed, loading points after {datetime.fromtimestamp(r[4])}')
+            inserted, skipped, last_timestamp = self._insert_points(source.points(), source.filename, after=r[4])
+            if skipped == r[3]:
+                self.cursor.execute(
+                    'REPLACE INTO sources VALUES (?, ?, ?, ?, ?, ?)',
+                    (source.filename, stat.st_size, stat.st_mtime_ns, r[3] + inserted, checksum, last_timestamp)
+                )
+                self.conn.commit()
+                logger.info(f'{inserted} new locations loaded from {source.filename}')
+                return r[4]
 
-                self.cursor.execute('INSERT INTO locations VALUES(?, ?, ?, ?);', (timestamp, lat, lng, accuracy))
+            logger.warning(f'{source.filename} has {skipped} points up to {datetime.fromtimestamp(r[4])}, {r[3]} were loaded before, reloading it')
+            self.conn.rollback()
 
-            logger.info(f"{len(locations['locations'])} locations loaded")
-            self.conn.commit()
+        deleted = self.cursor.execute('DELETE FROM locations WHERE source = ?', (source.filename, )).rowcount
+        logger.info(f'load data from {source.filename}')
+        inserted, _, last_timestamp = self._insert_points(source.points(), source.filename)
+        self.cursor.execute(
+            'REPLACE INTO sources VALUES (?, ?, ?, ?, ?, ?)',
+            (source.filename, stat.st_size, stat.st_mtime_ns, inserted, checksum, last_timestamp)
+        )
+        self.conn.commit()
+        logger.info(f'{inserted} locations loaded from {source.filename}')
+        return False if deleted else -math.inf
 
-    def get_location_at_timestamp(self, timestamp):
-        # Convert incoming datetime object to a timestamp int
-        t = int(timestamp.timestamp())
+    def load_json_data(self, jsonfile):
+        self.load_sources([GoogleHistorySource(jsonfile)])
+
+    def load_sources(self, sources):
+        """
+        Load track sources (see locations.sources) that are new or have changed since they were last loaded.
+        New points are merged straight in to the index, it's only rebuilt if points already loaded change.
+        """
+        rebuild = False
+        # (source, timestamp) for the rows to merge in to the index
+        appended = []
 
-        # Acquire a lock before running the below
         with self.lock:
-            # Find the two nearest values to the timestamp given, and return the lat/lng associated with both
-            self.cursor.execute('''
-                SELECT lat,lng FROM locations WHERE timestamp IN (
-                    SELECT MIN(timestamp) FROM locations where timestamp >= ?
-                    UNION
-                    SELECT MAX(timestamp) from locations where timestamp <= ?
+            self.create_tables()
+            for source in sources:
+                # A file that can't be read or parsed is left as it was, without stopping the others loading
+                try:
+                    after = self._load_source(source)
+                except Exception as e:
+                    self.conn.rollback()
+                    logger.error(f'Failed to load locations from {source.filename}: {e}')
+                    continue
+                if after is False:
+                    rebuild = True
+                elif after is not None:
+                    appended.append((source.filename, after))
+
+        # Past a few hundred changed files (and SQLite's parameter limit) a rebuild is just as quick
+        if rebuild or len(appended) > 400:
+            self.build_index()
+        elif appended:
+            with self.lock:
+                rows = self.conn.execute(
+                    'SELECT timestamp, lat, lng, accuracy FROM locations WHERE ' + ' OR '.join(['(source = ? AND timestamp > ?)'] * len(appended)),
+                    [value for source in appended for value in source]
                 )
-            ''', (t, t, ) )
+                self.index.merge(rows)
 
-            r = self.cursor.fetchall()
+    def build_index(self):
+        with self.lock:
+            self.create_tables()
+            count = self.cursor.execute('SELECT COUNT(*) FROM locations').fetchone()[0]
+            # Best accuracy first at each timestamp, unknown accuracy (-1) last, so the index keeps the best point
+            rows = self.conn.execute('SELECT timestamp, lat, lng, accuracy FROM locations ORDER BY timestamp, accuracy < 0, accuracy')
+            self.index.build(rows, count)
 
-            # Release the lock now we're done executing.
+    def get_locations_at_epochs(self, epochs):
+        # Epoch seconds in, two arrays of lat and lng out. NaN where there's no location.
+        return self.index.lookup(epochs, max_accuracy=self.max_accuracy, max_gap=self.max_gap)
 
-        # If there's more than one result, average the two
-        if len(r) > 1:
-            lat1= r[0][0]
-            lng1= r[0][1]
+    def get_locations_at_timestamps(self, timestamps):
+        return self.get_locations_at_epochs([t.timestamp() for t in timestamps])
 
-            lat2= r[1][0]
-            lng2= r[1][1]
+    def get_location_at_timestamp(self, timestamp):
+        lat, lng = self.get_locations_at_timestamps([timestamp])
+        lat, lng = float(lat[0]), float(lng[0])
 
-            # Average both, and convert to usual lat/lng number format
-            lat = ((lat1+lat2) / 2) / 1e7
-            lng = ((lng1+lng2) / 2) / 1e7
-        else:
-            # Just one result, convert to usual lat/lng number format
-            lat = r[0][0] / 1e7
-            lng = r[0][1] / 1e7
+        if math.isnan(lat):
+            logger.debug(f'no location near enough to timestamp {timestamp}')
+            return None
 
         logger.debug(f'location at timestamp {timestamp} = {lat},{lng}')
-        return [lat,lng]
\ No newline at end of file
+        return [lat,lng]
@@ -0,0 +1,200 @@
+from datetime import datetime, timezone
+import xml.etree.ElementTree as ET
+import os
+import re
+
+from locations.json_stream import iter_json_array
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def parse_timestamp(value):
+    # ISO 8601 as used by GPX, KML and newer Google exports, eg: 2020-03-01T10:00:00.5Z
+    value = value.strip().replace('Z', '+00:00')
+    # fromisoformat only takes 3 or 6 digits of fractional seconds
+    value = re.sub(r'\.(\d+)', lambda m: '.' + m.group(1)[:6].ljust(6, '0'), value)
+    t = datetime.fromisoformat(value)
+    if t.tzinfo is None:
+        t = t.replace(tzinfo=timezone.utc)
+    return t.timestamp()
+
+
+def parse_google_timestamp(item, ms_key='timestampMs', iso_key='timestamp'):
+    # Older Google exports have epoch milliseconds, newer ones ISO timestamps
+    if ms_key in item:
+        return int(item[ms_key]) / 1000
+    if iso_key in item:
+        return parse_timestamp(item[iso_key])
+    return None
+
+
+class TrackSource(object):
+    """
+    A file of location points. points() yields them one at a time as
+        (timestamp in epoch seconds, latitude * 1e7, longitude * 1e7, accuracy in metres or -1 if unknown)
+    without loading the whole file.
+    """
+    extensions = []
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def points(self):
+        raise NotImplementedError
+
+
+class GoogleHistorySource(TrackSource):
+    """
+    Google Takeout location history, Location History.json or Records.json:
+    {
+        "locations" : [ {
+            "timestampMs" : "1265928103110", # Epoch in ms, or "timestamp": "2010-02-11T22:41:43.110Z"
+            "latitudeE7" : -380005980, # Divide by 1e7
+            "longitudeE7" : 1452375430, # Divide by 1e7
+            "accuracy" : 1046
+        },
+    """
+    extensions = ['.JSON']
+
+    def points(self):
+        with open(self.filename) as f:
+            for l in iter_json_array(f, 'locations'):
+                timestamp = parse_google_timestamp(l)
+                if timestamp is None or 'latitudeE7' not in l or 'longitudeE7' not in l:
+                    continue
+                yield (timestamp, l['latitudeE7'], l['longitudeE7'], l.get('accuracy', -1))
+
+
+class GoogleSemanticSource(TrackSource):
+    """
+    Google Takeout semantic location history, Semantic Location History/2020/2020_MARCH.json:
+    {
+        "timelineObjects": [
+            {"placeVisit": {"location": {"latitudeE7": ..., "longitudeE7": ...}, "duration": {"startTimestamp": ..., "endTimestamp": ...}}},
+            {"activitySegment": {"startLocation": {...}, "endLocation": {...}, "duration": {...},
+                                 "simplifiedRawPath": {"points": [{"latE7": ..., "lngE7": ..., "timestamp": ..., "accuracyMeters": ...}]}}}
+        ]
+    }
+    """
+    extensions = ['.JSON']
+
+    @staticmethod
+    def _location_point(location, timestamp):
+        if not location or timestamp is None or 'latitudeE7' not in location or 'longitudeE7' not in location:
+            return None
+        return (timestamp, location['latitudeE7'], location['longitudeE7'], location.get('accuracyMetres', -1))
+
+    def points(self):
+        with open(self.filename) as f:
+            for timeline_object in iter_json_array(f, 'timelineObjects'):
+                if 'placeVisit' in timeline_object:
+                    visit = timeline_object['placeVisit']
+                    duration = visit.get('duration', {})
+                    for ms_key, iso_key in [('startTimestampMs', 'startTimestamp'), ('endTimestampMs', 'endTimestamp')]:
+                        point = self._location_point(visit.get('location'), parse_google_timestamp(duration, ms_key, iso_key))
+                        if point:
+                            yield point
+
+                elif 'activitySegment' in timeline_object:
+                    segment = timeline_object['activitySegment']
+                    duration = segment.get('duration', {})
+                    start = self._location_point(segment.get('startLocation'), parse_google_timestamp(duration, 'startTimestampMs', 'startTimestamp'))
+                    end = self._location_point(segment.get('endLocation'), parse_google_timestamp(duration, 'endTimestampMs', 'endTimestamp'))
+                    if start:
+                        yield start
+                    if end:
+                        yield end
+
+                    # Waypoints don't have times, but the raw path does
+                    for p in segment.get('simplifiedRawPath', {}).get('points', []):
+                        timestamp = parse_google_timestamp(p)
+                        if timestamp is not None and 'latE7' in p and 'lngE7' in p:
+                            yield (timestamp, p['latE7'], p['lngE7'], p.get('accuracyMeters', -1))
+
+
+class XMLTrackSource(TrackSource):
+    @staticmethod
+    def _tag(element):
+        # Drop the namespace, GPX and KML files come with a few different versions of them
+        return element.tag.rsplit('}', 1)[-1]
+
+
+class GPXSource(XMLTrackSource):
+    """
+    GPX tracks, routes and waypoints:
+        <trkpt lat="-38.0005980" lon="145.2375430"><time>2020-03-01T10:00:00Z</time></trkpt>
+    """
+    extensions = ['.GPX']
+
+    def points(self):
+        for _, element in ET.iterparse(self.filename, events=('end', )):
+            if self._tag(element) not in ['trkpt', 'rtept', 'wpt']:
+                continue
+
+            time = next((child.text for child in element if self._tag(child) == 'time'), None)
+            if time and 'lat' in element.attrib and 'lon' in element.attrib:
+                yield (
+                    parse_timestamp(time),
+                    round(float(element.attrib['lat']) * 1e7),
+                    round(float(element.attrib['lon']) * 1e7),
+                    -1
+                )
+            # Points are finished with once read, keep memory flat on big files
+            element.clear()
+
+
+class KMLSource(XMLTrackSource):
+    """
+    KML gx:Tracks, as exported from Google Maps timeline:
+        <gx:Track><when>2020-03-01T10:00:00Z</when><gx:coord>145.2375430 -38.0005980 0</gx:coord></gx:Track>
+    or placemarks with a time:
+        <Placemark><TimeStamp><when>...</when></TimeStamp><Point><coordinates>145.2375430,-38.0005980,0</coordinates></Point></Placemark>
+    """
+    extensions = ['.KML']
+
+    def points(self):
+        for _, element in ET.iterparse(self.filename, events=('end', )):
+            tag = self._tag(element)
+            if tag == 'Track':
+                # whens and coords are listed separately, in the same order
+                whens = [child.text for child in element if self._tag(child) == 'when']
+                coords = [child.text for child in element if self._tag(child) == 'coord']
+                for when, coord in zip(whens, coords):
+                    if when and coord:
+                        lng, lat = coord.split()[:2]
+                        yield (parse_timestamp(when), round(float(lat) * 1e7), round(float(lng) * 1e7), -1)
+                element.clear()
+
+            elif tag == 'Placemark':
+                when = next((e.text for e in element.iter() if self._tag(e) == 'when'), None)
+                coordinates = next((e.text for e in element.iter() if self._tag(e) == 'coordinates'), None)
+                if when and coordinates and len(coordinates.split()) == 1:
+                    lng, lat = coordinates.strip().split(',')[:2]
+                    yield (parse_timestamp(when), round(float(lat) * 1e7), round(float(lng) * 1e7), -1)
+                element.clear()
+
+
+def get_track_source(filename):
+    extension = os.path.splitext(filename)[-1].upper()
+    if extension in GPXSource.extensions:
+        return GPXSource(filename)
+    if extension in KMLSource.extensions:
+        return KMLSource(filename)
+    if extension in GoogleHistorySource.extensions:
+        # Both Google formats are json, tell them apart by what's near the start of the file
+        with open(filename) as f:
+            start = f.read(4096)
+        if '"timelineObjects"' in start:
+            return GoogleSemanticSource(filename)
+        return GoogleHistorySource(filename)
+    return None
+
+
+def find_track_sources(directory):
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            source = get_track_source(os.path.join(root, name))
+            if source:
+                yield source
@@ -1,85 +1,52 @@
 from config import config
 from locations.locations import Locations
+from locations.sources import find_track_sources
 from processed_images.processed_images import ProcessedImages
-from progress.bar import Bar
-
-# Note that we can probably do this in one query first:
-"""
-SELECT 
-    filename, 
-    json_extract(exif_data, '$.EXIF:GPSLatitude'), 
-    json_extract(exif_data, '$.EXIF:GPSLongitude'),
-    json_extract(exif_data, '$.EXIF:GPSLatitudeRef'),
-    json_extract(exif_data, '$.EXIF:GPSLongitudeRef')
-FROM photos 
-WHERE 
-    latitude IS NULL
-AND longitude IS NULL
-AND json_extract(exif_data, '$.EXIF:GPSLatitude') IS NOT NULL
-AND json_extract(exif_data, '$.EXIF:GPSLongitude') IS NOT NULL
-AND json_extract(exif_data, '$.EXIF:GPSLatitudeRef') IS NOT NULL
-AND json_extract(exif_data, '$.EXIF:GPSLongitudeRef') IS NOT NULL
-"""
-# An update statement for the above maybe?
-
+from processed_images.map_clusters import build_map_clusters
+import math
+import os
 
 if __name__ == '__main__':
-    locations=Locations(history_file=config['locations']['history_file'], history_db_dir=config['locations']['database_dir'], reload=False)
+    history_file = config['locations']['history_file']
+    if not os.path.isfile(history_file):
+        print(f'Location history {history_file} not found, using the locations already loaded')
+
+    # The history file is checked on every run. An unchanged size and mtime means it isn't read at all,
+    # and only points added since the last run are loaded if it has changed.
+    locations=Locations(
+        history_file=history_file,
+        history_db_dir=config['locations']['database_dir'],
+        reload=os.path.isfile(history_file),
+        max_accuracy=config['locations'].getint('max_accuracy'),
+        max_gap=config['locations'].getint('max_gap')
+    )
+
+    if config['locations'].get('track_dir'):
+        locations.load_sources(find_track_sources(config['locations']['track_dir']))
 
     # Scan for locations.
     photos = ProcessedImages(db_dir=config['photo_database']['database_dir'])
     photos.load()
-    
-    if config['locations'].getboolean('reprocess'):
-        photolist = photos.get_file_list()
-    else:
-        photolist = photos.get_empty_locations()
 
-    if not photolist:
+    # EXIF positions for every photo to tag come out of the database in one query
+    exif_tags = {k: v for k, v in config['locations_exif_tags'].items() if k not in config['DEFAULT'].keys()}
+    candidates = photos.get_location_candidates(exif_tags, include_tagged=config['locations'].getboolean('reprocess'))
+
+    if not candidates:
         print('Everything already has a location, doing nothing')
         exit()
 
-    progress = Bar('Processing photo locations', width=110, max=len(photolist), suffix='%(index)d/%(max)d - %(eta)ds')
-
-    for photo in photolist:
-        p = photos.retrieve(photo)
-        #print(p.filename)
-        # Check if it's already in the Exif here...
-
-        # We're looking for these:
-        #     "EXIF:GPSLatitudeRef": "N",
-        #     "EXIF:GPSLatitude": 50.1818237302778,
-        #     "EXIF:GPSLongitudeRef": "W",
-        #     "EXIF:GPSLongitude": 120.526573181111,
-        # If latitude ref is S, then negate latitude number
-        # If longitude ref is E, then negate longitude number
-        # This might be better data than location history? I'd hope not.
-
-        GPS_tags = [v for k,v in config['locations_exif_tags'].items()  if k not in config['DEFAULT'].keys()]
-        GPS_tags_exist = all([key in p.exif_data for key in GPS_tags])
-
-        if GPS_tags_exist:
-            lat = p.exif_data[config['locations_exif_tags']['lat']]
-            lng = p.exif_data[config['locations_exif_tags']['lng']]
-            
-            if lat and lng:
-                lat = float(lat)
-                lng = float(lng)
-
-                if p.exif_data[config['locations_exif_tags']['lat_ref']] == 'S' and lat > 0.0:
-                    lat = -lat
-                if p.exif_data[config['locations_exif_tags']['lng_ref']] == 'W' and lng > 0.0:
-                    lng = -lng
-                l = [lat,lng]
-            else:
-                l = locations.get_location_at_timestamp(p.date_taken)
-        else:  
-            l = locations.get_location_at_timestamp(p.date_taken)
+    # A GPS position in the EXIF is used over the location history
+    located = [(lat, lng, filename) for filename, _, lat, lng in candidates if lat and lng]
+    print(f'{len(located)} of {len(candidates)} photos have a location in their EXIF data')
 
-        print(p.filename)
-        photos.set_location(p.filename, l[0], l[1])
-        progress.next()
+    # Everything else is looked up in the location history in one go
+    lookup = [(filename, date_taken) for filename, date_taken, lat, lng in candidates if not (lat and lng) and date_taken is not None]
+    lats, lngs = locations.get_locations_at_epochs([date_taken for _, date_taken in lookup])
+    found = [(float(lat), float(lng), filename) for (filename, _), lat, lng in zip(lookup, lats, lngs) if not math.isnan(lat)]
+    print(f'{len(found)} of {len(lookup)} photos found in the location history')
 
-    progress.finish()
-    photos.commit()
-    photos.close()
\ No newline at end of file
+    photos.set_locations(located + found)
+    # Map clusters for the photoserver include the photos that have just been located
+    build_map_clusters(photos, config['map_maker'].getint('cluster_max_zoom'))
+    photos.close()
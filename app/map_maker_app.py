@@ -1,5 +1,6 @@
 from config import config
 from processed_images.processed_images import LockingProcessedImages
+from processed_images.map_clusters import build_map_clusters
 from progress.bar import Bar
 
 from datetime import datetime
@@ -8,84 +9,113 @@ import folium
 import folium.plugins as folium_plugins
 
 import os
+import json
 
 import base64
 import io
 from PIL import Image
 
-from concurrent.futures import ThreadPoolExecutor, wait, ALL_COMPLETED
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
 
 import logging
 logger = logging.getLogger(__name__)
 
 
-def make_popup(imagedata):
-    img = Image.open(io.BytesIO(base64.b64decode(imagedata)))
-    width, height = 128, 128
-    img.thumbnail((width, height, ))
+POPUP_SIZE = 128
 
-    buffered = io.BytesIO()
-    img.save(buffered, format="JPEG")
-    result = base64.b64encode(buffered.getvalue()).decode('utf-8')
+# Popup showing a photo's thumbnail from the photoserver, only loaded once the popup is opened
+LAZY_POPUP = '<img loading="lazy" width="{size}" src="{url}/thumbnail/{photo_id}?size={size}">'
 
-    html = '<img src="data:image/jpeg;base64,{}">'.format
-    iframe = folium.IFrame(html(result), width=width+20, height=height+20)
-    return folium.Popup(iframe, max_width=width+20)
+def popup_images(rows):
+    """
+    Runs in a worker process. (latitude, longitude, thumbnail) rows in, (latitude, longitude, base64 jpeg) out.
+    """
+    results = []
+    for latitude, longitude, imagedata in rows:
+        # Only databases from before the popup size was generated at ingest need to resize anything here
+        img = Image.open(io.BytesIO(imagedata))
+        if max(img.size) > POPUP_SIZE:
+            img.thumbnail((POPUP_SIZE, POPUP_SIZE, ))
+            buffered = io.BytesIO()
+            img.save(buffered, format="JPEG")
+            imagedata = buffered.getvalue()
 
-def single_image_process(photos, photo, progress_callback):
-    p = photos.retrieve(photo)
+        results.append((latitude, longitude, base64.b64encode(imagedata).decode('utf-8')))
+    return results
 
-    location = [p.latitude, p.longitude]
-    popup = make_popup(p.thumbnail)
-    icon = folium.Icon(color='red', icon='ok')
+def make_popup(encoded_image):
+    width, height = POPUP_SIZE, POPUP_SIZE
 
-    progress_callback()
-    return location, popup, icon
+    html = '<img src="data:image/jpeg;base64,{}">'.format
+    iframe = folium.IFrame(html(encoded_image), width=width+20, height=height+20)
+    return folium.Popup(iframe, max_width=width+20)
 
-    
+def lazy_marker_cluster(photos, start_date, end_date, photoserver_url):
+    # Only a location and id for each photo goes in the page, markers and popups are made by the browser as they're needed
+    data = [[latitude, longitude, photo_id] for photo_id, latitude, longitude in photos.get_locations_date_range(start_date, end_date)]
+    callback = """
+        function (row) {
+            var marker = L.marker(new L.LatLng(row[0], row[1]));
+            marker.bindPopup(%s.replace('{photo_id}', row[2]));
+            return marker;
+        }
+    """ % json.dumps(LAZY_POPUP.format(size=POPUP_SIZE, url=photoserver_url, photo_id='{photo_id}'))
+
+    print(f'Adding {len(data)} points to map...')
+    return folium_plugins.FastMarkerCluster(data, callback=callback)
 
-def date_range_map(photos, start_date, end_date):
-    print(f'Generating marker cluster map for date range: {start_date} - {end_date}')
 
-    photodaterange = photos.get_file_list_date_range(start_date, end_date)
+def embedded_marker_cluster(photos, start_date, end_date):
+    # Every thumbnail is embedded in the page so it works without the photoserver, but the page gets very large
+    count = photos.count_locations_date_range(start_date, end_date)
 
     mapdata = []
     mappopups = []
     mapicons = []
 
-    print('Launching threads to process markers')
+    print('Launching processes to make popups')
 
-    progress = Bar('Making markers', width=110, max=len(photodaterange), suffix='%(index)d/%(max)d - %(eta)ds')
+    # Rows come out of the database a chunk at a time, and the chunks are decoded and resized across all cores
+    # Only a couple of chunks per core are read ahead of the processes, so thumbnails aren't all held at once
+    progress = Bar('Making markers', width=110, max=count, suffix='%(index)d/%(max)d - %(eta)ds')
+    max_pending = (os.cpu_count() or 1) * 2
 
-    with ThreadPoolExecutor() as executor:
-        results = [
-            executor.submit(
-                single_image_process,
-                photos, 
-                photo, 
-                progress.next
-            )
-            for photo in photodaterange
-        ]
-        wait(results, return_when=ALL_COMPLETED)
-
-        print('Threads completed, getting results')
+    def add_markers(results):
         for result in results:
-            if result.result():
-                location, popup, icon = result.result()
-                mapdata.append(location)
-                mappopups.append(popup)
-                mapicons.append(icon)
+            popups = result.result()
+            for latitude, longitude, encoded_image in popups:
+                mapdata.append([latitude, longitude])
+                mappopups.append(make_popup(encoded_image))
+                mapicons.append(folium.Icon(color='red', icon='ok'))
+            progress.next(len(popups))
+
+    with ProcessPoolExecutor() as executor:
+        pending = set()
+        for rows in photos.iter_located_thumbnails(start_date, end_date, POPUP_SIZE):
+            pending.add(executor.submit(popup_images, rows))
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                add_markers(done)
+        add_markers(as_completed(pending))
 
     progress.finish()
 
     print('Adding points to map...')
-    mc = folium_plugins.MarkerCluster(
+    return folium_plugins.MarkerCluster(
         locations = mapdata,
         popups = mappopups,
         icons = mapicons
     )
 
+
+def date_range_map(photos, start_date, end_date):
+    print(f'Generating marker cluster map for date range: {start_date} - {end_date}')
+
+    if config['map_maker'].getboolean('embed_thumbnails'):
+        mc = embedded_marker_cluster(photos, start_date, end_date)
+    else:
+        mc = lazy_marker_cluster(photos, start_date, end_date, config['map_maker']['photoserver_url'])
+
     m = folium.Map(control_scale=True)
     m.add_child(mc)
     m.save(config['DEFAULT']['output_dir'] + os.sep + 'marker_cluster.html')
@@ -93,6 +123,72 @@ def date_range_map(photos, start_date, end_date):
     print('Marker cluster map generated!')
 
 
+def cluster_map(photos, max_zoom, photoserver_url):
+    """
+    A map of every photo that gets the precomputed clusters in view from the photoserver as it's moved around,
+    so the page is the same size however many photos there are.
+    """
+    print('Generating cluster map')
+    build_map_clusters(photos, max_zoom)
+
+    m = folium.Map(control_scale=True)
+    script = """
+        (function () {
+            var map = %(map)s;
+            var url = %(url)s;
+            var popup = %(popup)s;
+            var clusters = L.layerGroup().addTo(map);
+            var query = 'query getClusters($zoom: Int!, $south: Float!, $west: Float!, $north: Float!, $east: Float!) { ' +
+                'clusters(zoom: $zoom, south: $south, west: $west, north: $north, east: $east) { latitude longitude count photoid } }';
+
+            function wrap(lng) {
+                return ((lng + 180) %% 360 + 360) %% 360 - 180;
+            }
+
+            function loadClusters() {
+                var bounds = map.getBounds();
+                var whole_world = bounds.getEast() - bounds.getWest() >= 360;
+                var variables = {
+                    zoom: Math.min(map.getZoom(), %(max_zoom)d),
+                    south: Math.max(bounds.getSouth(), -90),
+                    north: Math.min(bounds.getNorth(), 90),
+                    west: whole_world ? -180 : wrap(bounds.getWest()),
+                    east: whole_world ? 180 : wrap(bounds.getEast())
+                };
+                fetch(url + '/graphql', {
+                    method: 'POST',
+                    headers: {'Content-Type': 'application/json'},
+                    body: JSON.stringify({query: query, variables: variables})
+                }).then(function (response) {
+                    return response.json();
+                }).then(function (result) {
+                    clusters.clearLayers();
+                    result.data.clusters.forEach(function (cluster) {
+                        var marker = L.marker([cluster.latitude, cluster.longitude], {
+                            icon: L.divIcon({html: '<div><span>' + cluster.count + '</span></div>', className: 'marker-cluster marker-cluster-medium', iconSize: [40, 40]})
+                        });
+                        marker.bindPopup(popup.replace('{photo_id}', cluster.photoid));
+                        clusters.addLayer(marker);
+                    });
+                });
+            }
+
+            map.on('moveend', loadClusters);
+            loadClusters();
+        })();
+    """ % {
+        'map': m.get_name(),
+        'url': json.dumps(photoserver_url),
+        'popup': json.dumps(LAZY_POPUP.format(size=POPUP_SIZE, url=photoserver_url, photo_id='{photo_id}')),
+        'max_zoom': max_zoom
+    }
+    # The marker cluster plugin brings the styles for the cluster icons
+    m.add_child(folium_plugins.MarkerCluster())
+    m.get_root().script.add_child(folium.Element(script))
+    m.save(config['DEFAULT']['output_dir'] + os.sep + 'cluster_map.html')
+    print('Cluster map generated!')
+
+
 def heatmap(photos):
     print('Generating heat map')
     m = folium.Map(control_scale=True)
@@ -111,6 +207,9 @@ if __name__ == '__main__':
     if config['map_maker'].getboolean('heatmap'):
         heatmap(photos)
 
+    if config['map_maker'].getboolean('cluster_map'):
+        cluster_map(photos, config['map_maker'].getint('cluster_max_zoom'), config['map_maker']['photoserver_url'])
+
     if config['map_maker'].getboolean('date_range_map'):
         start_date = datetime.strptime(config['map_maker']['date_range_start'], '%d-%m-%Y')
         end_date = datetime.strptime(config['map_maker']['date_range_end'], '%d-%m-%Y')
@@ -1,29 +1,128 @@
 from config import config
-from processed_images.processed_images import LockingProcessedImages, ProcessedImage
+from processed_images.processed_images import CachingProcessedImages, ProcessedImage, THUMBNAIL_SIZE, thumbnail_hash
 from hdr_finder_app import HDRProcessedImages
 
-from graphene import ObjectType, String, Schema, DateTime, List, Int, Field, Float, JSONString
+from graphene import ObjectType, String, Schema, DateTime, List, Int, Field, Float, JSONString, Boolean
 
-from flask import Flask
+from flask import Flask, Response, request, abort, jsonify
 from flask_graphql import GraphQLView
 from flask_cors import CORS
 
+from promise import Promise
+from promise.dataloader import DataLoader
+from collections import defaultdict
 
+import base64
+import json
+import os
 import logging
 import sys
 
 
-photos = LockingProcessedImages(db_dir=config['photo_database']['database_dir'])
+# Each process serving requests has its own, see photoserver_gunicorn.py.
+# PHOTOSERVER_DATABASE_DIR overrides the configured database, as used by photoserver_loadtest.py.
+photos = CachingProcessedImages(
+    db_dir=os.environ.get('PHOTOSERVER_DATABASE_DIR', config['photo_database']['database_dir']),
+    cache_bytes=config['photoserver'].getint('cache_bytes')
+)
 photos.load()
 
+class PhotoLoader(DataLoader):
+    # Every photo asked for while resolving a query is read in one go, without exif data
+    def batch_load_fn(self, filenames):
+        found = photos.retrieve_many(filenames, with_exif=False)
+        return Promise.resolve([found.get(filename) for filename in filenames])
+
+class ExifLoader(DataLoader):
+    # Only used when exifdata is asked for, so it's only read and parsed then
+    def batch_load_fn(self, filenames):
+        found = photos.retrieve_many(filenames)
+        return Promise.resolve([found[filename].exif_data if filename in found else None for filename in filenames])
+
+class ThumbnailLoader(DataLoader):
+    # Keys are (filename, size), one query for each size asked for
+    def batch_load_fn(self, keys):
+        filenames_by_size = defaultdict(list)
+        for filename, size in keys:
+            filenames_by_size[size].append(filename)
+        found = {size: photos.get_thumbnails(filenames, size) for size, filenames in filenames_by_size.items()}
+        return Promise.resolve([found[size].get(filename) for filename, size in keys])
+
+def make_context(request=None):
+    # Loaders only batch and cache within one request
+    return {
+        'request': request,
+        'photo_loader': PhotoLoader(),
+        'exif_loader': ExifLoader(),
+        'thumbnail_loader': ThumbnailLoader()
+    }
+
 class Photo(ObjectType):
     filetype = String()
     filename = String(required=True)
-    thumbnail = String()
+    thumbnail = String(size=Int(default_value=THUMBNAIL_SIZE))
     datetaken = DateTime()
     latitude = Float()
     longitude = Float()
     exifdata = JSONString()
+    photoid = Int()
+    # Path of the thumbnail on this server, for clients that can cache it over HTTP
+    thumbnailurl = String(size=Int(default_value=THUMBNAIL_SIZE))
+
+    @staticmethod
+    def resolve_thumbnailurl(root, info, size):
+        return f'/thumbnail/{root.photoid}?size={size}'
+
+    @staticmethod
+    def resolve_thumbnail(root, info, size):
+        # Only read when asked for, at the size asked for. The closest stored size is returned.
+        return info.context['thumbnail_loader'].load((root.filename, size)).then(
+            lambda thumbnail: base64.b64encode(thumbnail).decode('utf-8') if thumbnail else None
+        )
+
+    @staticmethod
+    def resolve_exifdata(root, info):
+        return info.context['exif_loader'].load(root.filename)
+
+    @staticmethod
+    def from_processed_image(p):
+        if p is None:
+            return None
+        return Photo(filetype=p.filetype,
+                     filename=p.filename,
+                     datetaken=p.date_taken,
+                     latitude=p.latitude,
+                     longitude=p.longitude,
+                     photoid=p.photo_id)
+
+# Most photos a page can have
+MAX_PAGE_SIZE = 500
+
+def encode_cursor(p):
+    # Opaque to clients, the (date_taken, filename) key of the last photo on a page, as stored
+    return base64.urlsafe_b64encode(json.dumps([p.date_taken_epoch, p.filename]).encode('utf-8')).decode('utf-8')
+
+def decode_cursor(cursor):
+    date_taken, filename = json.loads(base64.urlsafe_b64decode(cursor.encode('utf-8')))
+    return int(date_taken), str(filename)
+
+class PhotoPage(ObjectType):
+    photos = List(Photo)
+    # Pass as after to get the next page
+    endcursor = String()
+    hasnextpage = Boolean()
+
+class PhotoLocation(ObjectType):
+    filename = String(required=True)
+    latitude = Float()
+    longitude = Float()
+
+class MapCluster(ObjectType):
+    latitude = Float()
+    longitude = Float()
+    count = Int()
+    # Thumbnail of one photo from the cluster is at /thumbnail/<photoid>
+    photoid = Int()
 
 class HDRGroup(ObjectType):
   group = List(String)
@@ -31,7 +130,38 @@ class HDRGroup(ObjectType):
 class Query(ObjectType):
     photolist = List(String, startdatetime=DateTime(required=True), enddatetime=DateTime(required=True))
     photo = Field(Photo, filename=String(required=True))
+    photos = List(Photo, filenames=List(String, required=True))
+    photopage = Field(
+        PhotoPage,
+        first=Int(default_value=100),
+        after=String(),
+        startdatetime=DateTime(),
+        enddatetime=DateTime(),
+        filetype=String(),
+        camera=String(),
+        south=Float(),
+        west=Float(),
+        north=Float(),
+        east=Float(),
+        haslocation=Boolean()
+    )
     hdrgroups = List(HDRGroup)
+    locations = List(
+        PhotoLocation,
+        south=Float(required=True),
+        west=Float(required=True),
+        north=Float(required=True),
+        east=Float(required=True),
+        limit=Int()
+    )
+    clusters = List(
+        MapCluster,
+        zoom=Int(required=True),
+        south=Float(required=True),
+        west=Float(required=True),
+        north=Float(required=True),
+        east=Float(required=True)
+    )
 
     @staticmethod
     def resolve_photolist(root, info, startdatetime, enddatetime):
@@ -39,15 +169,62 @@ class Query(ObjectType):
 
     @staticmethod
     def resolve_photo(root, info, filename):
-        p = photos.retrieve(filename)
+        return info.context['photo_loader'].load(filename).then(Photo.from_processed_image)
 
-        return Photo(filetype=p.filetype, 
-                     filename=p.filename, 
-                     thumbnail=p.thumbnail, 
-                     datetaken=p.date_taken, 
-                     latitude=p.latitude, 
-                     longitude=p.longitude,
-                     exifdata=p.exif_data)
+    @staticmethod
+    def resolve_photos(root, info, filenames):
+        # In the order asked for, with nulls for files that aren't there
+        return info.context['photo_loader'].load_many(filenames).then(
+            lambda found: [Photo.from_processed_image(p) for p in found]
+        )
+
+    @staticmethod
+    def resolve_photopage(root, info, first, after=None, startdatetime=None, enddatetime=None, filetype=None, camera=None,
+                          south=None, west=None, north=None, east=None, haslocation=None):
+        first = max(0, min(first, MAX_PAGE_SIZE))
+        bbox = (south, west, north, east)
+        if any(v is None for v in bbox):
+            if any(v is not None for v in bbox):
+                raise ValueError('south, west, north and east all have to be given for a bounding box')
+            bbox = None
+
+        # One more than asked for, to know if there's another page
+        page = photos.get_photo_page(
+            first=first + 1,
+            after=decode_cursor(after) if after else None,
+            start_date=startdatetime,
+            end_date=enddatetime,
+            filetype=filetype,
+            camera=camera,
+            bbox=bbox,
+            has_location=haslocation
+        )
+        has_next_page = len(page) > first
+        page = page[:first]
+
+        # Anything else asking for these photos in this request doesn't need to read them again
+        for p in page:
+            info.context['photo_loader'].prime(p.filename, p)
+
+        return PhotoPage(
+            photos=[Photo.from_processed_image(p) for p in page],
+            endcursor=encode_cursor(page[-1]) if page else after,
+            hasnextpage=has_next_page
+        )
+
+    @staticmethod
+    def resolve_locations(root, info, south, west, north, east, limit=None):
+        return [
+            PhotoLocation(filename=filename, latitude=latitude, longitude=longitude)
+            for filename, latitude, longitude in photos.get_locations_in_bbox(south, west, north, east, limit)
+        ]
+
+    @staticmethod
+    def resolve_clusters(root, info, zoom, south, west, north, east):
+        return [
+            MapCluster(latitude=latitude, longitude=longitude, count=count, photoid=photo_id)
+            for latitude, longitude, count, photo_id in photos.get_map_clusters(zoom, south, west, north, east)
+        ]
 
     @staticmethod
     def resolve_hdrgroups(root, info):
@@ -65,12 +242,42 @@ schema = Schema(query=Query)
 app = Flask(__name__)
 CORS(app)
 
-app.add_url_rule('/graphql', view_func=GraphQLView.as_view(
+class PhotoGraphQLView(GraphQLView):
+    def get_context(self):
+        return make_context(request)
+
+app.add_url_rule('/graphql', view_func=PhotoGraphQLView.as_view(
     'graphql',
     schema=schema,
     graphiql=True
 ))
 
+def thumbnail_headers(response, etag):
+    response.set_etag(etag)
+    # Browsers can reuse it for a while without asking, then check it's the same with the ETag
+    response.cache_control.public = True
+    response.cache_control.max_age = config['photoserver'].getint('thumbnail_max_age')
+    return response
+
+@app.route('/thumbnail/<int:photo_id>')
+def thumbnail(photo_id):
+    size = request.args.get('size', THUMBNAIL_SIZE, type=int)
+
+    # A client that already has it only needs the hash checked, the image itself isn't read
+    if request.if_none_match:
+        etag, _ = photos.get_thumbnail_by_id(photo_id, size, with_thumbnail=False)
+        if etag and request.if_none_match.contains(etag):
+            return thumbnail_headers(Response(status=304), etag)
+
+    etag, thumbnail = photos.get_thumbnail_by_id(photo_id, size)
+    if not thumbnail:
+        abort(404)
+    return thumbnail_headers(Response(thumbnail, mimetype='image/jpeg'), etag or thumbnail_hash(thumbnail))
+
+@app.route('/metrics')
+def metrics():
+    return jsonify({'cache': photos.get_stats()})
+
 # Serve this out via flask to be picked up in React:
 @app.route('/queries')
 def queries():
@@ -79,6 +286,17 @@ query getPhotolist {
   photolist(startdatetime: "2020-03-01T00:00:00", enddatetime: "2020-03-02T00:00:00")
 }
 
+query getPhotoPage($startdatetime: DateTime, $enddatetime: DateTime, $after: String) {
+  photopage(startdatetime: $startdatetime, enddatetime: $enddatetime, after: $after, first: 100) {
+    photos {
+      filename
+      datetaken
+    }
+    endcursor
+    hasnextpage
+  }
+}
+
 query getPhoto($filename: String!) {
   photo(filename: $filename) {
     filetype
@@ -86,11 +304,38 @@ query getPhoto($filename: String!) {
     datetaken
     latitude
     longitude
-    thumbnail
+    thumbnailurl
     exifdata
   }
 }
 
+query getLocations($south: Float!, $west: Float!, $north: Float!, $east: Float!) {
+  locations(south: $south, west: $west, north: $north, east: $east) {
+    filename
+    latitude
+    longitude
+  }
+}
+
+query getClusters($zoom: Int!, $south: Float!, $west: Float!, $north: Float!, $east: Float!) {
+  clusters(zoom: $zoom, south: $south, west: $west, north: $north, east: $east) {
+    latitude
+    longitude
+    count
+    photoid
+  }
+}
+
+query getPhotos($filenames: [String]!) {
+  photos(filenames: $filenames) {
+    filetype
+    filename
+    datetaken
+    latitude
+    longitude
+  }
+}
+
 query gethdrgroups {
   hdrgroups {
     group
@@ -99,4 +344,5 @@ query gethdrgroups {
 """
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0')
\ No newline at end of file
+    # Development server, run through gunicorn with photoserver_gunicorn.py in production
+    app.run(host='0.0.0.0', threaded=True)
\ No newline at end of file
@@ -0,0 +1,27 @@
+# Gunicorn settings for running the photoserver in production:
+#   gunicorn --config photoserver_gunicorn.py photoserver_app:app
+# Each worker process imports the app itself and opens its own connections, a read only one per thread,
+# so the app mustn't be preloaded in the master where forked workers would share its connections.
+
+# Named so it isn't taken as gunicorn's own config setting
+from config import config as photo_config
+
+import multiprocessing
+import os
+
+bind = photo_config['photoserver'].get('bind', fallback='0.0.0.0:5000')
+# Threads handle concurrency within a worker, so one per core is enough. Each has its own cache, see config.ini.
+workers = photo_config['photoserver'].getint('workers', fallback=0) or multiprocessing.cpu_count()
+worker_class = 'gthread'
+threads = photo_config['photoserver'].getint('threads', fallback=4)
+preload_app = False
+accesslog = '-'
+
+
+def on_starting(server):
+    # Create and migrate the schema once, before the workers start and all try at the same time
+    from processed_images.processed_images import ProcessedImages
+
+    photos = ProcessedImages(db_dir=os.environ.get('PHOTOSERVER_DATABASE_DIR', photo_config['photo_database']['database_dir']))
+    photos.load()
+    photos.connections.close()
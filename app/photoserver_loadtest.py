@@ -0,0 +1,225 @@
+# Measure photoserver requests/s against a synthetic photo database, eg:
+#   python photoserver_loadtest.py --photos 100000 --concurrency 32 --duration 30
+# Without --url the database is built in a temporary directory and served with gunicorn using photoserver_gunicorn.py,
+# or with the development server if --dev-server is given.
+
+import argparse
+import datetime
+import http.client
+import io
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from PIL import Image
+
+from processed_images.processed_images import ProcessedImages, ProcessedImage
+
+logger = logging.getLogger(__name__)
+
+START_DATE = datetime.datetime(2015, 1, 1)
+# Synthetic photos are spread over this many days from START_DATE
+DAYS = 365 * 5
+
+PHOTOLIST_QUERY = '''
+query getPhotolist($startdatetime: DateTime!, $enddatetime: DateTime!) {
+  photolist(startdatetime: $startdatetime, enddatetime: $enddatetime)
+}'''
+
+PHOTO_QUERY = '''
+query getPhoto($filename: String!) {
+  photo(filename: $filename) { filetype filename datetaken latitude longitude thumbnailurl exifdata }
+}'''
+
+PHOTOPAGE_QUERY = '''
+query getPhotoPage($startdatetime: DateTime, $enddatetime: DateTime) {
+  photopage(startdatetime: $startdatetime, enddatetime: $enddatetime, first: 100) {
+    photos { filename datetaken thumbnailurl }
+    endcursor
+    hasnextpage
+  }
+}'''
+
+BBOXPAGE_QUERY = '''
+query getBboxPage($south: Float, $west: Float, $north: Float, $east: Float) {
+  photopage(south: $south, west: $west, north: $north, east: $east, first: 100) {
+    photos { filename datetaken latitude longitude thumbnailurl }
+    endcursor
+    hasnextpage
+  }
+}'''
+
+
+def synthetic_filename(i):
+    return f'/work/stash/Photos/Synthetic/IMG_{i:07d}.JPG'
+
+
+def build_database(db_dir, count, batch_size=5000):
+    print(f'Building synthetic database of {count} photos in {db_dir}')
+    buffered = io.BytesIO()
+    Image.new('RGB', (128, 96), (120, 140, 160)).save(buffered, format='JPEG')
+    thumbnail = buffered.getvalue()
+
+    random.seed(0)
+    os.makedirs(db_dir, exist_ok=True)
+    photos = ProcessedImages(db_dir=db_dir)
+    photos.load()
+    for start in range(0, count, batch_size):
+        photos.add_many([
+            ProcessedImage(
+                filetype='JPG',
+                filename=synthetic_filename(i),
+                date_taken=START_DATE + datetime.timedelta(seconds=random.randrange(DAYS * 86400)),
+                exif_data={'EXIF:Model': random.choice(['Canon EOS M5', 'Canon EOS 60D']), 'EXIF:ISO': random.choice([100, 400, 1600])},
+                thumbnail=thumbnail,
+                thumbnails={128: thumbnail},
+                latitude=None,
+                longitude=None
+            )
+            for i in range(start, min(start + batch_size, count))
+        ])
+    photos.set_locations([(random.uniform(-45, -10), random.uniform(110, 155), synthetic_filename(i)) for i in range(0, count, 2)])
+    photos.connections.close()
+
+
+def start_server(db_dir, url, dev_server):
+    env = dict(os.environ, PHOTOSERVER_DATABASE_DIR=db_dir)
+    if dev_server:
+        command = [sys.executable, 'photoserver_app.py']
+    else:
+        command = ['gunicorn', '--config', 'photoserver_gunicorn.py', '--bind', urlsplit(url).netloc, '--access-logfile', '/dev/null', 'photoserver_app:app']
+    print(f'Starting {" ".join(command)}')
+    server = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    # Wait for it to answer
+    for _ in range(600):
+        try:
+            connection = http.client.HTTPConnection(urlsplit(url).netloc, timeout=1)
+            connection.request('GET', '/metrics')
+            connection.getresponse().read()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError(f'photoserver did not start on {url}')
+
+
+def random_day():
+    start = START_DATE + datetime.timedelta(days=random.randrange(DAYS))
+    return start.isoformat(), (start + datetime.timedelta(days=1)).isoformat()
+
+
+def make_request(kind, count):
+    # (method, path, body) for one request of a kind
+    if kind == 'photolist':
+        start, end = random_day()
+        return 'POST', '/graphql', {'query': PHOTOLIST_QUERY, 'variables': {'startdatetime': start, 'enddatetime': end}}
+    if kind == 'photo':
+        return 'POST', '/graphql', {'query': PHOTO_QUERY, 'variables': {'filename': synthetic_filename(random.randrange(count))}}
+    if kind == 'photopage':
+        start, end = random_day()
+        return 'POST', '/graphql', {'query': PHOTOPAGE_QUERY, 'variables': {'startdatetime': start, 'enddatetime': end}}
+    if kind == 'bboxpage':
+        # Boxes of a degree or less are small enough to be paged from the location index
+        south, west = random.uniform(-45, -11), random.uniform(110, 154)
+        size = random.uniform(0.1, 1)
+        return 'POST', '/graphql', {'query': BBOXPAGE_QUERY, 'variables': {'south': south, 'west': west, 'north': south + size, 'east': west + size}}
+    if kind == 'thumbnail':
+        return 'GET', f'/thumbnail/{random.randrange(count) + 1}?size=128', None
+    raise ValueError(f'unknown request kind {kind}')
+
+
+def run_client(url, kind, count, deadline):
+    # One keep-alive connection making requests one after another until the deadline, returns the latency of each
+    connection = http.client.HTTPConnection(urlsplit(url).netloc, timeout=30)
+    latencies = []
+    errors = 0
+    while time.time() < deadline:
+        method, path, body = make_request(kind, count)
+        start = time.time()
+        try:
+            if body is None:
+                connection.request(method, path)
+            else:
+                connection.request(method, path, body=json.dumps(body), headers={'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            content = response.read()
+            # GraphQL errors can come back with a 200
+            if response.status != 200 or (body is not None and b'"errors"' in content):
+                errors += 1
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            connection.close()
+            connection = http.client.HTTPConnection(urlsplit(url).netloc, timeout=30)
+            continue
+        latencies.append(time.time() - start)
+    connection.close()
+    return latencies, errors
+
+
+def load_test(url, kind, count, concurrency, duration):
+    deadline = time.time() + duration
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda _: run_client(url, kind, count, deadline), range(concurrency)))
+
+    latencies = sorted(latency for client_latencies, _ in results for latency in client_latencies)
+    errors = sum(client_errors for _, client_errors in results)
+    if not latencies:
+        print(f'{kind:>10}: no requests completed, {errors} errors')
+        return
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+    print(
+        f'{kind:>10}: {len(latencies) / duration:8.1f} req/s, '
+        f'p50 {percentile(0.5):6.1f}ms, p99 {percentile(0.99):6.1f}ms, {errors} errors'
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the photoserver against a synthetic photo database')
+    parser.add_argument('--photos', type=int, default=100000, help='Number of photos in the synthetic database')
+    parser.add_argument('--db-dir', help='Keep the synthetic database here instead of a temporary directory, built if it is not there')
+    parser.add_argument('--url', help='Test an already running photoserver, serving a database built with the same --photos')
+    parser.add_argument('--port', type=int, default=5099, help='Port to start the photoserver on when there is no --url')
+    parser.add_argument('--dev-server', action='store_true', help='Start the Flask development server instead of gunicorn')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10, help='Seconds to run each kind of request for')
+    parser.add_argument('--kinds', nargs='+', default=['photolist', 'photo', 'photopage', 'bboxpage', 'thumbnail'])
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    server = None
+    temporary_dir = None
+    try:
+        if not args.url:
+            db_dir = args.db_dir
+            if not db_dir:
+                temporary_dir = tempfile.TemporaryDirectory()
+                db_dir = temporary_dir.name
+            if not os.path.exists(db_dir + os.sep + 'images.db'):
+                build_database(db_dir, args.photos)
+
+            # The development server always runs on 5000
+            args.url = f'http://127.0.0.1:{5000 if args.dev_server else args.port}'
+            server = start_server(db_dir, args.url, args.dev_server)
+
+        print(f'Testing {args.url} with {args.concurrency} concurrent clients for {args.duration}s each')
+        for kind in args.kinds:
+            load_test(args.url, kind, args.photos, args.concurrency, args.duration)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+        if temporary_dir:
+            temporary_dir.cleanup()
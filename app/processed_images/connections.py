@@ -0,0 +1,97 @@
+import sqlite3
+import pathlib
+import weakref
+
+from threading import local, Lock
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class _Reader(object):
+    # Only referenced from its thread's local storage, so it's collected and its connection closed when the thread exits
+    def __init__(self, conn):
+        self.conn = conn
+        self.close = weakref.finalize(self, conn.close)
+
+
+class ConnectionManager(object):
+    """
+    One writer connection, and a read only connection per thread, closed when the thread exits.
+    The database is put in WAL mode so readers don't block each other or the writer.
+    """
+    def __init__(self, db_file, cache_size=-65536, mmap_size=268435456):
+        self.db_file = db_file
+        # Negative cache sizes are in KiB, positive ones in pages.
+        self.cache_size = cache_size
+        self.mmap_size = mmap_size
+
+        self.writer = None
+        self.local = local()
+        self.readers = weakref.WeakSet()
+        self.readers_lock = Lock()
+
+        self.version_conn = None
+        self.version_lock = Lock()
+
+    def _set_pragmas(self, conn):
+        conn.execute(f'PRAGMA cache_size = {int(self.cache_size)};')
+        conn.execute(f'PRAGMA mmap_size = {int(self.mmap_size)};')
+        conn.execute('PRAGMA temp_store = MEMORY;')
+
+    def get_writer(self):
+        if not self.writer:
+            logger.debug(f'Opening writer connection to {self.db_file}')
+            self.writer = sqlite3.connect(self.db_file, check_same_thread=False, isolation_level=None)
+            self.writer.execute('PRAGMA journal_mode = WAL;')
+            # Safe in WAL mode, only the last transactions can be lost on power failure, not corrupted
+            self.writer.execute('PRAGMA synchronous = NORMAL;')
+            # So rows removed by REPLACE fire delete triggers, which keep the location index in sync
+            self.writer.execute('PRAGMA recursive_triggers = ON;')
+            self._set_pragmas(self.writer)
+        return self.writer
+
+    def get_reader(self):
+        reader = getattr(self.local, 'reader', None)
+        if not reader:
+            # The writer has to have created the database (and WAL files) before readers can open it
+            self.get_writer()
+
+            logger.debug(f'Opening read only connection to {self.db_file}')
+            uri = pathlib.Path(self.db_file).absolute().as_uri() + '?mode=ro'
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False, isolation_level=None)
+            self._set_pragmas(conn)
+            reader = _Reader(conn)
+            self.local.reader = reader
+            with self.readers_lock:
+                self.readers.add(reader)
+        return reader.conn
+
+    def get_data_version(self):
+        """
+        A number that changes whenever the database is committed to by any other connection, including this
+        process's writer. Only comparable with other values from this method.
+        """
+        with self.version_lock:
+            if not self.version_conn:
+                self.get_writer()
+                uri = pathlib.Path(self.db_file).absolute().as_uri() + '?mode=ro'
+                self.version_conn = sqlite3.connect(uri, uri=True, check_same_thread=False, isolation_level=None)
+            return self.version_conn.execute('PRAGMA data_version;').fetchone()[0]
+
+    def close(self):
+        logger.debug(f'Closing all connections to {self.db_file}')
+        with self.readers_lock:
+            for reader in list(self.readers):
+                reader.close()
+            self.readers = weakref.WeakSet()
+        self.local = local()
+
+        with self.version_lock:
+            if self.version_conn:
+                self.version_conn.close()
+                self.version_conn = None
+
+        if self.writer:
+            self.writer.close()
+            self.writer = None
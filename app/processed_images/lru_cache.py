@@ -0,0 +1,94 @@
+import datetime
+import sys
+
+from collections import OrderedDict
+from dataclasses import is_dataclass, fields
+from threading import Lock
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Returned by get when a key isn't cached, as None is a value that can be cached
+MISSING = object()
+
+
+def estimate_size(value):
+    """
+    Rough number of bytes a value holds, following lists, tuples, dicts and dataclasses.
+    Close enough to keep a cache near its limit, without the cost of an exact count.
+    """
+    if value is None or isinstance(value, (bool, int, float, datetime.datetime)):
+        return 32
+    if isinstance(value, (str, bytes)):
+        return sys.getsizeof(value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(estimate_size(v) for v in value)
+    if is_dataclass(value):
+        return 64 + sum(estimate_size(getattr(value, f.name)) for f in fields(value))
+    return sys.getsizeof(value)
+
+
+class ByteLRUCache(object):
+    """
+    Least recently used cache bounded by the estimated bytes of what's in it rather than the number of entries.
+    Values are shared with everyone that gets them, so they mustn't be changed.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        # key -> (value, size), least recently used first
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.clears = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return MISSING
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size=None):
+        size = estimate_size(value) if size is None else size
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.bytes += size
+
+            while self.bytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+            self.clears += 1
+
+    def get_stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'clears': self.clears
+            }
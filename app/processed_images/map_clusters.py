@@ -0,0 +1,87 @@
+import math
+import time
+
+import numpy as np
+from humanfriendly import format_timespan
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Cells are a quarter of a 256 pixel web map tile wide, so clusters are about 64 pixels apart on screen
+CELLS_PER_TILE = 4
+# Web mercator doesn't go any closer to the poles than this
+MAX_LATITUDE = 85.0511287798
+
+
+def cells_at_zoom(zoom):
+    return (2 ** zoom) * CELLS_PER_TILE
+
+
+def to_cells(lat, lng, zoom):
+    """
+    Grid cell of each of an array of points at a zoom level, as x and y arrays. Cells are squares on a web mercator
+    map, numbered from the top left (-180, MAX_LATITUDE), the same way as map tiles.
+    """
+    n = cells_at_zoom(zoom)
+    lat = np.radians(np.clip(np.asarray(lat, dtype=np.float64), -MAX_LATITUDE, MAX_LATITUDE))
+    x = (np.asarray(lng, dtype=np.float64) + 180.0) / 360.0
+    y = (1.0 - np.log(np.tan(lat) + 1.0 / np.cos(lat)) / math.pi) / 2.0
+    return np.clip((x * n).astype(np.int64), 0, n - 1), np.clip((y * n).astype(np.int64), 0, n - 1)
+
+
+def bbox_to_cell_ranges(south, west, north, east, zoom):
+    # Ranges of cells covering a bounding box, as ((min x, max x), (min y, max y)) pairs. Two if it crosses the antimeridian.
+    x, y = to_cells([north, south], [west, east], zoom)
+    y_range = (int(y[0]), int(y[1]))
+    if west <= east:
+        return [((int(x[0]), int(x[1])), y_range)]
+    return [((int(x[0]), cells_at_zoom(zoom) - 1), y_range), ((0, int(x[1])), y_range)]
+
+
+def make_clusters(ids, lat, lng, zoom):
+    """
+    Group points in to grid cells at a zoom level. Returns a row for each cell with points in it:
+        (zoom, cell x, cell y, number of points, mean latitude, mean longitude, lowest id in the cell)
+    """
+    cell_x, cell_y = to_cells(lat, lng, zoom)
+    keys, inverse, counts = np.unique(cell_x * cells_at_zoom(zoom) + cell_y, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+
+    mean_lat = np.bincount(inverse, weights=lat) / counts
+    mean_lng = np.bincount(inverse, weights=lng) / counts
+
+    # One photo to show for each cluster, the first by id in each cell
+    order = np.lexsort((ids, inverse))
+    first = order[np.r_[0, np.flatnonzero(np.diff(inverse[order])) + 1]]
+
+    return zip(
+        [zoom] * len(keys),
+        (keys // cells_at_zoom(zoom)).tolist(),
+        (keys % cells_at_zoom(zoom)).tolist(),
+        counts.tolist(),
+        mean_lat.tolist(),
+        mean_lng.tolist(),
+        ids[first].tolist()
+    )
+
+
+def build_map_clusters(photos, max_zoom=14):
+    """
+    Precompute clusters of every geotagged photo at each zoom level up to max_zoom, replacing what's in the
+    map_clusters table. Closer in than max_zoom there are few enough photos in view to get them individually
+    with get_locations_in_bbox.
+    """
+    start = time.time()
+    rows = photos.get_location_ids()
+    ids = np.array([r[0] for r in rows], dtype=np.int64)
+    lat = np.array([r[1] for r in rows], dtype=np.float64)
+    lng = np.array([r[2] for r in rows], dtype=np.float64)
+    rows = None
+
+    clusters = []
+    if len(ids):
+        for zoom in range(max_zoom + 1):
+            clusters.extend(make_clusters(ids, lat, lng, zoom))
+
+    photos.set_map_clusters(clusters)
+    logger.info(f'Built {len(clusters)} map clusters of {len(ids)} photos for zoom levels 0-{max_zoom} in {format_timespan(time.time() - start)}')
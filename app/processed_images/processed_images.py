@@ -1,4 +1,6 @@
 import json
+import base64
+import hashlib
 from dataclasses import dataclass
 import datetime
 import os
@@ -6,28 +8,65 @@ import sqlite3
 import time
 from humanfriendly import format_timespan
 
+from config import config
+from processed_images.connections import ConnectionManager
+from processed_images.map_clusters import bbox_to_cell_ranges
+from processed_images.lru_cache import ByteLRUCache, MISSING
 
-from threading import Thread, Lock
+
+from threading import Thread, Lock, RLock
+from contextlib import contextmanager
 from queue import Queue, Empty
 
 import logging
 logger = logging.getLogger(__name__)
 
+# Long edge of the default thumbnail, others sizes may be stored alongside it
+THUMBNAIL_SIZE = 512
+# EXIF tag filtered on for the camera a photo was taken with
+CAMERA_MODEL_TAG = 'EXIF:Model'
+
 @dataclass
 class ProcessedImage():
     filetype: str
     filename: str
     date_taken: datetime.datetime
     exif_data: dict
-    thumbnail: str
+    thumbnail: bytes
     latitude: float
     longitude: float
+    file_size: int = None
+    file_mtime: int = None
+    file_inode: int = None
+    # Every size generated at ingest, long edge size -> jpeg bytes
+    thumbnails: dict = None
+    # rowid in the photos table, only set on photos read from the database
+    photo_id: int = None
+    # date_taken as stored, epoch seconds. Also only set on photos read from the database, it's the exact key to
+    # page from where date_taken is local time that may not convert back to the same value.
+    date_taken_epoch: int = None
+
 
+def thumbnail_hash(thumbnail):
+    # Stored with each thumbnail, and used as its ETag
+    return hashlib.sha256(thumbnail).hexdigest()
 
 
 class ProcessedImages(object):
     def __init__(self, db_dir=None):
         self.db_file = db_dir + os.sep + 'images.db'
+        self.connections = ConnectionManager(
+            self.db_file,
+            cache_size=config['photo_database'].getint('cache_size', fallback=-65536),
+            mmap_size=config['photo_database'].getint('mmap_size', fallback=268435456)
+        )
+        # column name -> EXIF tag, for EXIF fields that get their own indexed column
+        if config.has_section('exif_columns'):
+            self.exif_columns = {k: v for k, v in config['exif_columns'].items() if k not in config['DEFAULT'].keys()}
+        else:
+            self.exif_columns = {}
+        # Generated columns need SQLite 3.31, before that the same EXIF fields get expression indexes instead
+        self.generated_columns = sqlite3.sqlite_version_info >= (3, 31, 0)
 
     def _run_query(self, *args, **kwargs):
         start = time.time()
@@ -36,11 +75,152 @@ class ProcessedImages(object):
         end = time.time()
         logger.debug(f'Query time: {format_timespan(end-start)}')
         return results
-        
+
+    def _run_read_query(self, *args, **kwargs):
+        # Reads use this thread's own read only connection, so they don't queue behind the writer
+        start = time.time()
+        logger.debug(f"Running read query: {args[0]}")
+        results = self.connections.get_reader().execute(*args, **kwargs)
+        end = time.time()
+        logger.debug(f'Query time: {format_timespan(end-start)}')
+        return results
+
+    def _run_many(self, *args, **kwargs):
+        start = time.time()
+        logger.debug(f"Running query for many rows: {args[0]}")
+        results = self.conn.executemany(*args, **kwargs)
+        end = time.time()
+        logger.debug(f'Query time: {format_timespan(end-start)}')
+        return results
+
+    @contextmanager
+    def _transaction(self):
+        self._run_query('BEGIN')
+        try:
+            yield
+        except:
+            self._run_query('ROLLBACK')
+            raise
+        self._run_query('COMMIT')
+
+    def _add_missing_columns(self, table, columns):
+        # Bring tables in older databases up to date with the current schema
+        existing = [r[1] for r in self._run_query(f'PRAGMA table_info({table})')]
+        for name, definition in columns.items():
+            if name not in existing:
+                logger.info(f'Adding column {name} to {table}')
+                self._run_query(f'ALTER TABLE {table} ADD COLUMN {name} {definition}')
+
+    @staticmethod
+    def _exif_path(tag):
+        # JSON path to an EXIF tag, quoted as the tags have colons in them
+        return "'$.\"" + tag.replace("'", "''") + "\"'"
+
+    def exif_expression(self, tag):
+        # SQL for the value of an EXIF tag, the promoted column if there is one, otherwise pulled out of the JSON.
+        # Without generated columns it's always pulled out of the JSON, which the expression indexes match.
+        if self.generated_columns:
+            for column, column_tag in self.exif_columns.items():
+                if column_tag == tag:
+                    return column
+        return f'json_extract(exif_data, {self._exif_path(tag)})'
+
+    def _create_location_index(self):
+        """
+        An R*Tree of photo locations, by photos rowid, kept up to date by triggers on photos.
+        Deleted photos and photos without a location aren't in it.
+        """
+        exists = self._run_query('''
+            SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'photo_locations'
+        ''').fetchone()
+
+        self._run_query('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS photo_locations USING rtree(id, min_lat, max_lat, min_lng, max_lng);
+        ''')
+        self._run_query('''
+            CREATE TRIGGER IF NOT EXISTS photo_locations_insert AFTER INSERT ON photos
+            WHEN new.latitude IS NOT NULL AND new.longitude IS NOT NULL AND new.deleted = 0
+            BEGIN
+                INSERT INTO photo_locations VALUES (new.rowid, new.latitude, new.latitude, new.longitude, new.longitude);
+            END;
+        ''')
+        self._run_query('''
+            CREATE TRIGGER IF NOT EXISTS photo_locations_update AFTER UPDATE OF latitude, longitude, deleted ON photos
+            BEGIN
+                DELETE FROM photo_locations WHERE id = old.rowid;
+                INSERT INTO photo_locations
+                    SELECT new.rowid, new.latitude, new.latitude, new.longitude, new.longitude
+                    WHERE new.latitude IS NOT NULL AND new.longitude IS NOT NULL AND new.deleted = 0;
+            END;
+        ''')
+        self._run_query('''
+            CREATE TRIGGER IF NOT EXISTS photo_locations_delete AFTER DELETE ON photos
+            BEGIN
+                DELETE FROM photo_locations WHERE id = old.rowid;
+            END;
+        ''')
+
+        if not exists:
+            logger.info('Building photo location index')
+            with self._transaction():
+                self._run_query('''
+                    INSERT INTO photo_locations
+                        SELECT rowid, latitude, latitude, longitude, longitude
+                        FROM photos
+                        WHERE latitude IS NOT NULL AND longitude IS NOT NULL AND deleted = 0
+                ''')
+
+    def _create_page_indexes(self):
+        # Indexes in get_photo_page order for each of its filters, so a page is a short walk along one of them
+        self._run_query('CREATE INDEX IF NOT EXISTS photos_page ON photos(deleted, date_taken, filename)')
+        self._run_query('CREATE INDEX IF NOT EXISTS photos_page_filetype ON photos(filetype, deleted, date_taken, filename)')
+        # Covers the location filters, so photos outside a bounding box are skipped without reading their row
+        self._run_query('''
+            CREATE INDEX IF NOT EXISTS photos_page_location ON photos(deleted, date_taken, filename, latitude, longitude)
+            WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+        ''')
+        for column, tag in self.exif_columns.items():
+            if tag == CAMERA_MODEL_TAG:
+                self._run_query(f'CREATE INDEX IF NOT EXISTS photos_page_{column} ON photos({self.exif_expression(tag)}, deleted, date_taken, filename)')
+
+    def _create_exif_columns(self):
+        """
+        Generated columns for the EXIF fields in [exif_columns], each with an index. They're virtual, so nothing
+        changes on insert and existing rows don't need a backfill, but the index holds the values so queries on them
+        don't have to parse any JSON. Columns that have been taken out of the config are dropped.
+        On SQLite older than 3.31 there are no columns, each field gets an index on its json_extract expression.
+        """
+        existing = {r[1]: r[6] for r in self._run_query('PRAGMA table_xinfo(photos)')}
+
+        for column, tag in self.exif_columns.items():
+            if not column.isidentifier():
+                raise ValueError(f'EXIF column name {column} is not a valid column name')
+            if self.generated_columns and column not in existing:
+                logger.info(f'Adding column {column} for EXIF tag {tag} to photos')
+                self._run_query(f'ALTER TABLE photos ADD COLUMN {column} GENERATED ALWAYS AS (json_extract(exif_data, {self._exif_path(tag)})) VIRTUAL')
+            self._run_query(f'CREATE INDEX IF NOT EXISTS photos_exif_{column} ON photos({self.exif_expression(tag)})')
+
+        indexes = [r[0] for r in self._run_query('''
+            SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'photos' AND name LIKE 'photos_exif_%'
+        ''')]
+        for index in indexes:
+            if index[len('photos_exif_'):] not in self.exif_columns:
+                logger.info(f'Dropping EXIF index {index}')
+                self._run_query(f'DROP INDEX IF EXISTS {index}')
+
+        # hidden is 2 for virtual generated columns, 3 for stored ones
+        for column, hidden in existing.items():
+            if hidden in (2, 3) and column not in self.exif_columns:
+                if sqlite3.sqlite_version_info < (3, 35, 0):
+                    logger.warning(f'EXIF column {column} is no longer used, SQLite {sqlite3.sqlite_version} is too old to drop it')
+                    continue
+                logger.info(f'Dropping EXIF column {column} from photos')
+                self._run_query(f'ALTER TABLE photos DROP COLUMN {column}')
+
     def load(self):
         logger.info(f'Opening photo database {self.db_file}')
 
-        self.conn = sqlite3.connect(self.db_file, check_same_thread=False, isolation_level=None)
+        self.conn = self.connections.get_writer()
 
         logger.debug('Create table if not exists')
         self._run_query('''
@@ -49,41 +229,201 @@ class ProcessedImages(object):
                 filetype TEXT NOT NULL,
                 date_taken INTEGER,
                 exif_data TEXT,
-                thumbnail TEXT,
                 latitude REAL,
-                longitude REAL
+                longitude REAL,
+                file_size INTEGER,
+                file_mtime INTEGER,
+                file_inode INTEGER,
+                deleted INTEGER NOT NULL DEFAULT 0
             );
         ''')
-        self._run_query('PRAGMA journal=MEMORY')
-        self._run_query('PRAGMA temp_store = MEMORY;')
+        self._add_missing_columns('photos', {
+            'file_size': 'INTEGER',
+            'file_mtime': 'INTEGER',
+            'file_inode': 'INTEGER',
+            'deleted': 'INTEGER NOT NULL DEFAULT 0'
+        })
+
+        # Thumbnails are kept out of the photos table so metadata queries never have to read past them.
+        # hash comes before thumbnail, so reading it doesn't mean reading through the thumbnail's overflow pages.
+        self._run_query('''
+            CREATE TABLE IF NOT EXISTS thumbnails (
+                filename TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                hash TEXT,
+                thumbnail BLOB,
+                PRIMARY KEY (filename, size)
+            );
+        ''')
+        self.order_thumbnail_columns()
+        self.migrate_thumbnails()
+        self.hash_thumbnails()
 
         self._run_query('''CREATE UNIQUE INDEX IF NOT EXISTS photos_filename_ids on photos(filename);''')
         self._run_query('''CREATE INDEX IF NOT EXISTS photos_filetypes on photos(filetype);''')
         self._run_query('''CREATE INDEX IF NOT EXISTS photos_dates on photos(date_taken);''')
-        
+        self._create_exif_columns()
+        self._create_location_index()
+        self._create_page_indexes()
+
+        # Filled by map_clusters.build_map_clusters, photo_id is the photos rowid of one photo in the cluster
+        self._run_query('''
+            CREATE TABLE IF NOT EXISTS map_clusters (
+                zoom INTEGER NOT NULL,
+                cell_x INTEGER NOT NULL,
+                cell_y INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                latitude REAL NOT NULL,
+                longitude REAL NOT NULL,
+                photo_id INTEGER NOT NULL,
+                PRIMARY KEY (zoom, cell_x, cell_y)
+            );
+        ''')
+
+
+    def order_thumbnail_columns(self):
+        # Older thumbnails tables have no hash, or had it added after thumbnail, copy them into one with it before
+        columns = [r[1] for r in self._run_query('PRAGMA table_info(thumbnails)')]
+        if 'hash' in columns and columns.index('hash') < columns.index('thumbnail'):
+            return
+
+        logger.info('Rebuilding thumbnails table with hashes ahead of thumbnails')
+        with self._transaction():
+            self._run_query('''
+                CREATE TABLE thumbnails_ordered (
+                    filename TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    hash TEXT,
+                    thumbnail BLOB,
+                    PRIMARY KEY (filename, size)
+                );
+            ''')
+            self._run_query(f'''
+                INSERT INTO thumbnails_ordered (filename, size, hash, thumbnail)
+                SELECT filename, size, {'hash' if 'hash' in columns else 'NULL'}, thumbnail FROM thumbnails
+            ''')
+            self._run_query('DROP TABLE thumbnails')
+            self._run_query('ALTER TABLE thumbnails_ordered RENAME TO thumbnails')
+        logger.warning('Thumbnails table rebuilt, run VACUUM on the photo database to reclaim the space the old one used')
+
+    def migrate_thumbnails(self, batch_size=1000):
+        # Older databases kept base64 thumbnails in photos.thumbnail, move them to the thumbnails table as raw bytes
+        columns = [r[1] for r in self._run_query('PRAGMA table_info(photos)')]
+        if 'thumbnail' not in columns:
+            return
+
+        migrated = 0
+        last_rowid = -1
+        while True:
+            rows = self._run_query('''
+                SELECT rowid, filename, thumbnail FROM photos WHERE rowid > ? AND thumbnail IS NOT NULL ORDER BY rowid LIMIT ?
+            ''', (last_rowid, batch_size, )).fetchall()
+            if not rows:
+                break
+            last_rowid = rows[-1][0]
+
+            with self._transaction():
+                self._run_many('''
+                    REPLACE INTO thumbnails (filename, size, thumbnail, hash) VALUES (?,?,?,?)
+                ''', [
+                    (filename, THUMBNAIL_SIZE, thumbnail, thumbnail_hash(thumbnail))
+                    for filename, thumbnail in ((filename, base64.b64decode(thumbnail)) for _, filename, thumbnail in rows)
+                ])
+                self._run_many('''
+                    UPDATE photos SET thumbnail = NULL WHERE rowid = ?
+                ''', [(rowid, ) for rowid, _, _ in rows])
+            migrated += len(rows)
+            logger.info(f'Migrated {migrated} thumbnails to the thumbnails table')
+
+        if migrated:
+            logger.warning('Thumbnails migrated, run VACUUM on the photo database to reclaim the space they used')
+
+    def hash_thumbnails(self, batch_size=1000):
+        # Thumbnails written before hashes were stored with them
+        hashed = 0
+        last_rowid = -1
+        while True:
+            rows = self._run_query('''
+                SELECT rowid, thumbnail FROM thumbnails WHERE rowid > ? AND hash IS NULL ORDER BY rowid LIMIT ?
+            ''', (last_rowid, batch_size, )).fetchall()
+            if not rows:
+                break
+            last_rowid = rows[-1][0]
+
+            with self._transaction():
+                self._run_many('''
+                    UPDATE thumbnails SET hash = ? WHERE rowid = ?
+                ''', [(thumbnail_hash(thumbnail), rowid) for rowid, thumbnail in rows if thumbnail])
+            hashed += len(rows)
+            logger.info(f'Hashed {hashed} thumbnails')
 
     def start(self):
         self.load()
 
-    def add(self, metadata):
-        insert_values = (
+    def _insert_values(self, metadata):
+        return (
             metadata.filename,
             metadata.filetype,
             int(metadata.date_taken.timestamp()),
             json.dumps(metadata.exif_data),
-            metadata.thumbnail,
+            metadata.file_size,
+            metadata.file_mtime,
+            metadata.file_inode
         )
+
+    def _write_rows(self, metadatas):
+        with self._transaction():
+            # Updated in place rather than replaced, so a photo keeps its rowid, which is its id outside the database.
+            # The location is cleared as REPLACE did, to be worked out again for the new date taken.
+            self._run_many('''
+                INSERT INTO
+                photos (filename, filetype, date_taken, exif_data, file_size, file_mtime, file_inode, deleted)
+                VALUES (?,?,?,?,?,?,?,0)
+                ON CONFLICT(filename) DO UPDATE SET
+                    filetype = excluded.filetype,
+                    date_taken = excluded.date_taken,
+                    exif_data = excluded.exif_data,
+                    latitude = NULL,
+                    longitude = NULL,
+                    file_size = excluded.file_size,
+                    file_mtime = excluded.file_mtime,
+                    file_inode = excluded.file_inode,
+                    deleted = 0
+            ''', [self._insert_values(metadata) for metadata in metadatas])
+            # Sizes that are no longer generated would otherwise keep showing the old image
+            self._run_many('''
+                DELETE FROM thumbnails WHERE filename = ?
+            ''', [(metadata.filename, ) for metadata in metadatas])
+            self._run_many('''
+                REPLACE INTO thumbnails (filename, size, thumbnail, hash) VALUES (?,?,?,?)
+            ''', [
+                (metadata.filename, size, thumbnail, thumbnail_hash(thumbnail))
+                for metadata in metadatas
+                for size, thumbnail in (metadata.thumbnails or {THUMBNAIL_SIZE: metadata.thumbnail}).items()
+                if thumbnail
+            ])
+
+    def add(self, metadata):
         logger.debug(f'INSERT or REPLACE row for {metadata.filename}')
         try:
-            self._run_query('''
-                REPLACE INTO 
-                photos (filename, filetype, date_taken, exif_data, thumbnail) 
-                VALUES (?,?,?,?,?)  
-            ''', insert_values)
-            self.conn.commit()
+            self._write_rows([metadata])
         except Exception as e:
                 logger.error(f'Failed to insert {metadata.filename}: {e}')
 
+    def add_many(self, metadatas):
+        # All rows in one transaction, if any of them fail then fall back to adding one at a time
+        logger.debug(f'INSERT or REPLACE {len(metadatas)} rows')
+        try:
+            self._write_rows(metadatas)
+        except Exception as e:
+            logger.error(f'Failed to insert batch of {len(metadatas)} rows, adding individually: {e}')
+            # Written here rather than through add, which subclasses override to queue the row again
+            for metadata in metadatas:
+                try:
+                    self._write_rows([metadata])
+                except Exception as e:
+                    logger.error(f'Failed to insert {metadata.filename}: {e}')
+
     def create_hdr_set(self, filenames):
         name = '-'.join([os.path.basename(i.filename) for i in filenames])
         inserts = [(name, i.filename) for i in filenames]
@@ -96,7 +436,7 @@ class ProcessedImages(object):
     def check_if_processed(self, filename):
         logger.debug(f'Checking if {filename} already exists in DB')
         
-        rs = self._run_query('''
+        rs = self._run_read_query('''
             SELECT EXISTS(SELECT 1 FROM photos WHERE filename=?)
         ''', ( filename, ))
         r = rs.fetchone()
@@ -107,10 +447,36 @@ class ProcessedImages(object):
         else:
             return False
 
+    def get_file_manifest(self):
+        # What each file looked like when it was processed, to tell if it's changed since:
+        # filename -> (file_size, file_mtime, file_inode, deleted)
+        logger.debug(f'Get manifest of all processed files')
+        rs = self._run_read_query('''
+            SELECT filename, file_size, file_mtime, file_inode, deleted FROM photos
+        ''')
+        results = {r[0]: r[1:] for r in rs}
+        logger.debug(f'{len(results)} files loaded in manifest')
+        return results
+
+    def set_file_stats(self, file_stats):
+        # file_stats is a list of (file_size, file_mtime, file_inode, filename)
+        logger.debug(f'Updating file stats for {len(file_stats)} files')
+        with self._transaction():
+            self._run_many('''
+                UPDATE photos SET file_size = ?, file_mtime = ?, file_inode = ? WHERE filename = ?;
+            ''', file_stats)
+
+    def mark_deleted(self, filenames):
+        logger.debug(f'Marking {len(filenames)} files as deleted')
+        with self._transaction():
+            self._run_many('''
+                UPDATE photos SET deleted = 1 WHERE filename = ?;
+            ''', [(filename, ) for filename in filenames])
+
     def get_file_list(self):
         logger.debug(f'Get list of all filenames ordered by date taken')
-        rs = self._run_query('''
-            SELECT filename FROM photos ORDER BY filename, date_taken
+        rs = self._run_read_query('''
+            SELECT filename FROM photos WHERE deleted = 0 ORDER BY filename, date_taken
         ''')
         r = rs.fetchall()
         results = [x[0] for x in r]
@@ -126,8 +492,8 @@ class ProcessedImages(object):
 
         logger.debug(f'Arguments for query = {daterange}')
 
-        rs = self._run_query('''
-            SELECT filename FROM photos WHERE date_taken BETWEEN :start AND :end;
+        rs = self._run_read_query('''
+            SELECT filename FROM photos WHERE date_taken BETWEEN :start AND :end AND deleted = 0;
         ''',
             daterange
         )
@@ -138,8 +504,8 @@ class ProcessedImages(object):
 
     def get_raw_files(self):
         logger.debug(f'Get list of all filenames ordered by date taken')
-        rs = self._run_query('''
-            SELECT filename FROM photos WHERE filetype = 'RAW' ORDER BY filename, date_taken
+        rs = self._run_read_query('''
+            SELECT filename FROM photos WHERE filetype = 'RAW' AND deleted = 0 ORDER BY filename, date_taken
         ''')
         r = rs.fetchall()
         results = [x[0] for x in r]
@@ -147,16 +513,108 @@ class ProcessedImages(object):
     
     def get_locations(self):
         logger.debug(f'Getting a list of all files and locations')
-        rs = self._run_query('''
-            SELECT filename, latitude, longitude FROM photos where latitude IS NOT NULL AND longitude IS NOT NULL
+        rs = self._run_read_query('''
+            SELECT filename, latitude, longitude FROM photos where latitude IS NOT NULL AND longitude IS NOT NULL AND deleted = 0
         ''')
         results = rs.fetchall()
         return results
 
+    def get_locations_in_bbox(self, south, west, north, east, limit=None):
+        """
+        (filename, latitude, longitude) of photos inside a bounding box, from the location index.
+        A box with west greater than east crosses the antimeridian.
+        """
+        logger.debug(f'Getting files with locations in {south},{west} - {north},{east}')
+        if west <= east:
+            lng_ranges = [(west, east)]
+        else:
+            lng_ranges = [(west, 180.0), (-180.0, east)]
+
+        # The R*Tree stores 32 bit floats rounded outwards, so the exact check is done against photos
+        query = ' UNION ALL '.join(['''
+            SELECT photos.filename, photos.latitude, photos.longitude
+            FROM photo_locations
+            JOIN photos ON photos.rowid = photo_locations.id
+            WHERE photo_locations.min_lat <= ? AND photo_locations.max_lat >= ?
+            AND photo_locations.min_lng <= ? AND photo_locations.max_lng >= ?
+            AND photos.latitude BETWEEN ? AND ?
+            AND photos.longitude BETWEEN ? AND ?
+            AND photos.deleted = 0
+        '''] * len(lng_ranges))
+        params = [
+            value
+            for min_lng, max_lng in lng_ranges
+            for value in (north, south, max_lng, min_lng, south, north, min_lng, max_lng)
+        ]
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(limit)
+
+        rs = self._run_read_query(query, params)
+        return rs.fetchall()
+
+    @staticmethod
+    def _bbox_candidates(south, west, north, east):
+        # SQL and parameters for the photos rowids in the location index that could be inside a bounding box
+        if west <= east:
+            lng_ranges = [(west, east)]
+        else:
+            lng_ranges = [(west, 180.0), (-180.0, east)]
+        query = ' UNION ALL '.join([
+            'SELECT id FROM photo_locations WHERE min_lat <= ? AND max_lat >= ? AND min_lng <= ? AND max_lng >= ?'
+        ] * len(lng_ranges))
+        params = [value for min_lng, max_lng in lng_ranges for value in (north, south, max_lng, min_lng)]
+        return query, params
+
+    def get_location_ids(self):
+        logger.debug(f'Getting ids and locations of all files with locations')
+        rs = self._run_read_query('''
+            SELECT rowid, latitude, longitude FROM photos WHERE latitude IS NOT NULL AND longitude IS NOT NULL AND deleted = 0
+        ''')
+        return rs.fetchall()
+
+    def get_locations_date_range(self, start_date, end_date):
+        logger.debug(f'Getting ids and locations of files with locations between {start_date} and {end_date}')
+        rs = self._run_read_query('''
+            SELECT rowid, latitude, longitude FROM photos
+            WHERE date_taken BETWEEN ? AND ? AND latitude IS NOT NULL AND longitude IS NOT NULL AND deleted = 0
+            ORDER BY date_taken
+        ''', (int(start_date.timestamp()), int(end_date.timestamp()), ))
+        return rs.fetchall()
+
+    def count_locations_date_range(self, start_date, end_date):
+        # How many rows get_locations_date_range would return
+        rs = self._run_read_query('''
+            SELECT COUNT(*) FROM photos
+            WHERE date_taken BETWEEN ? AND ? AND latitude IS NOT NULL AND longitude IS NOT NULL AND deleted = 0
+        ''', (int(start_date.timestamp()), int(end_date.timestamp()), ))
+        return rs.fetchone()[0]
+
+    def set_map_clusters(self, clusters):
+        # clusters is a list of (zoom, cell_x, cell_y, count, latitude, longitude, photo_id), replacing all existing ones
+        logger.debug(f'Replacing map clusters with {len(clusters)} new ones')
+        with self._transaction():
+            self._run_query('DELETE FROM map_clusters')
+            self._run_many('''
+                INSERT INTO map_clusters (zoom, cell_x, cell_y, count, latitude, longitude, photo_id) VALUES (?,?,?,?,?,?,?)
+            ''', clusters)
+
+    def get_map_clusters(self, zoom, south, west, north, east):
+        # (latitude, longitude, count, photo_id) of the precomputed clusters in a bounding box at a zoom level
+        logger.debug(f'Getting map clusters at zoom {zoom} in {south},{west} - {north},{east}')
+        results = []
+        for (min_x, max_x), (min_y, max_y) in bbox_to_cell_ranges(south, west, north, east, zoom):
+            rs = self._run_read_query('''
+                SELECT latitude, longitude, count, photo_id FROM map_clusters
+                WHERE zoom = ? AND cell_x BETWEEN ? AND ? AND cell_y BETWEEN ? AND ?
+            ''', (zoom, min_x, max_x, min_y, max_y, ))
+            results.extend(rs.fetchall())
+        return results
+
     def get_empty_locations(self):
         logger.debug(f'Get list of all filenames that do not have any location data')
-        rs = self._run_query('''
-            SELECT filename, date_taken FROM photos WHERE latitude IS NULL and longitude IS NULL ORDER BY filename, date_taken
+        rs = self._run_read_query('''
+            SELECT filename, date_taken FROM photos WHERE latitude IS NULL and longitude IS NULL AND deleted = 0 ORDER BY filename, date_taken
         ''')
         r = rs.fetchall()
         results = [x[0] for x in r]
@@ -168,10 +626,77 @@ class ProcessedImages(object):
             UPDATE photos SET latitude = ?, longitude = ? WHERE filename = ?;
         ''', (lat, lng, filename, ))
 
-    def retrieve(self, filename):
+    def get_location_candidates(self, exif_tags, include_tagged=False):
+        """
+        (filename, date_taken, EXIF latitude, EXIF longitude) for every photo without a location, or every photo
+        if include_tagged. exif_tags maps lat, lng, lat_ref and lng_ref to EXIF tag names. The EXIF position is
+        signed by its refs, and is None unless all four tags are there.
+        """
+        logger.debug(f'Get EXIF positions of photos to geotag')
+        lat, lng, lat_ref, lng_ref = [self.exif_expression(exif_tags[key]) for key in ['lat', 'lng', 'lat_ref', 'lng_ref']]
+        rs = self._run_read_query(f'''
+            SELECT
+                filename,
+                date_taken,
+                CASE
+                    WHEN {lat_ref} IS NULL OR {lng_ref} IS NULL THEN NULL
+                    WHEN {lat_ref} = 'S' THEN -ABS(CAST({lat} AS REAL))
+                    ELSE CAST({lat} AS REAL)
+                END,
+                CASE
+                    WHEN {lat_ref} IS NULL OR {lng_ref} IS NULL THEN NULL
+                    WHEN {lng_ref} = 'W' THEN -ABS(CAST({lng} AS REAL))
+                    ELSE CAST({lng} AS REAL)
+                END
+            FROM photos
+            WHERE deleted = 0 {'' if include_tagged else 'AND latitude IS NULL AND longitude IS NULL'}
+            ORDER BY filename
+        ''')
+        return rs.fetchall()
+
+    def set_locations(self, locations):
+        # locations is a list of (latitude, longitude, filename)
+        logger.debug(f'Adding coords for {len(locations)} files')
+        with self._transaction():
+            self._run_many('''
+                UPDATE photos SET latitude = ?, longitude = ? WHERE filename = ?;
+            ''', locations)
+
+    # Columns for _to_processed_image, exif_data is left out unless it's wanted. Qualified, as photos can be joined
+    # to other tables, and an unqualified rowid doesn't work against a join at all.
+    _retrieve_columns = (
+        'photos.filename, photos.filetype, photos.date_taken, {exif_data}, photos.latitude, photos.longitude, '
+        'photos.file_size, photos.file_mtime, photos.file_inode, photos.rowid'
+    )
+
+    @staticmethod
+    def _to_processed_image(r, with_exif=True):
+        return ProcessedImage(
+            filename = r[0],
+            filetype = r[1],
+            date_taken = datetime.datetime.fromtimestamp(r[2]),
+            exif_data = (json.loads(r[3]) if r[3] else dict()) if with_exif else None,
+            thumbnail = None,
+            latitude = r[4],
+            longitude = r[5],
+            file_size = r[6],
+            file_mtime = r[7],
+            file_inode = r[8],
+            photo_id = r[9],
+            date_taken_epoch = r[2]
+        )
+
+    @staticmethod
+    def _chunks(items, size=500):
+        # Keeps IN (...) lists under SQLite's limit on query parameters
+        items = list(items)
+        for i in range(0, len(items), size):
+            yield items[i:i + size]
+
+    def retrieve(self, filename, with_thumbnail=True):
         logger.debug(f'Retreive data for {filename}')
-        rs = self._run_query('''
-            SELECT filename, filetype, date_taken, exif_data, thumbnail, latitude, longitude
+        rs = self._run_read_query(f'''
+            SELECT {self._retrieve_columns.format(exif_data='photos.exif_data')}
             FROM photos
             WHERE filename = ?
         ''', ( filename, ))
@@ -179,19 +704,158 @@ class ProcessedImages(object):
         if r == None:
             return None
 
-        exif_data = json.loads(r[3]) if r[3] else dict()
-
-        p = ProcessedImage(
-            filename = r[0],
-            filetype = r[1],
-            date_taken = datetime.datetime.fromtimestamp(r[2]),
-            exif_data = exif_data,
-            thumbnail = r[4],
-            latitude = r[5],
-            longitude = r[6]
-        )
+        p = self._to_processed_image(r)
+        if with_thumbnail:
+            p.thumbnail = self.get_thumbnail(filename)
         return p
+
+    def retrieve_many(self, filenames, with_exif=True):
+        """
+        As retrieve without thumbnails, for many files in a few queries. Returns a dict of filename -> ProcessedImage,
+        files that aren't in the database are left out. exif_data is None unless with_exif.
+        """
+        logger.debug(f'Retreive data for {len(filenames)} files')
+        results = {}
+        for chunk in self._chunks(filenames):
+            rs = self._run_read_query(f'''
+                SELECT {self._retrieve_columns.format(exif_data='photos.exif_data' if with_exif else 'NULL')}
+                FROM photos
+                WHERE filename IN ({','.join('?' * len(chunk))})
+            ''', chunk)
+            for r in rs:
+                results[r[0]] = self._to_processed_image(r, with_exif)
+        return results
+
+    def get_thumbnails(self, filenames, size=THUMBNAIL_SIZE):
+        # As get_thumbnail for many files at once, a dict of filename -> thumbnail for the ones that have one
+        logger.debug(f'Retrieve {size} thumbnails for {len(filenames)} files')
+        results = {}
+        for chunk in self._chunks(filenames):
+            rs = self._run_read_query(f'''
+                SELECT filename, thumbnail FROM (
+                    SELECT
+                        filename,
+                        thumbnail,
+                        ROW_NUMBER() OVER (PARTITION BY filename ORDER BY size < ?, ABS(size - ?)) AS closest
+                    FROM thumbnails
+                    WHERE filename IN ({','.join('?' * len(chunk))})
+                )
+                WHERE closest = 1
+            ''', [size, size] + chunk)
+            results.update(rs.fetchall())
+        return results
+
+    # Bounding boxes with fewer photos than this in them are paged through the location index
+    bbox_candidate_limit = 5000
+
+    def get_photo_page(self, first=100, after=None, start_date=None, end_date=None, filetype=None, camera=None, bbox=None, has_location=None):
+        """
+        Up to first photos (as retrieve_many, without exif data) ordered by date taken and then filename,
+        starting after the (date_taken, filename) key after. Filters that are None aren't applied.
+        bbox is (south, west, north, east), west greater than east crosses the antimeridian.
+        """
+        logger.debug(f'Getting page of {first} photos after {after}')
+        conditions = ['deleted = 0']
+        params = []
+
+        if after is not None:
+            conditions.append('(date_taken, filename) > (?, ?)')
+            params.extend(after)
+        if start_date is not None:
+            conditions.append('date_taken >= ?')
+            params.append(int(start_date.timestamp()))
+        if end_date is not None:
+            conditions.append('date_taken <= ?')
+            params.append(int(end_date.timestamp()))
+        if filetype is not None:
+            conditions.append('filetype = ?')
+            params.append(filetype)
+        if camera is not None:
+            conditions.append(f'{self.exif_expression(CAMERA_MODEL_TAG)} = ?')
+            params.append(camera)
+        if has_location or bbox is not None:
+            conditions.append('latitude IS NOT NULL AND longitude IS NOT NULL')
+        elif has_location is not None:
+            conditions.append('(latitude IS NULL OR longitude IS NULL)')
+        if bbox is not None:
+            south, west, north, east = bbox
+            conditions.append('latitude BETWEEN ? AND ?')
+            params.extend([south, north])
+            conditions.append('longitude BETWEEN ? AND ?' if west <= east else '(longitude >= ? OR longitude <= ?)')
+            params.extend([west, east])
+
+        source = 'photos'
+        if bbox is not None:
+            # A box with few photos in it is quickest from the location index, sorting the few there are. Otherwise
+            # they're common enough that walking the date order location index finds a page of them soon enough.
+            candidates, candidate_params = self._bbox_candidates(*bbox)
+            count = self._run_read_query(
+                f'SELECT COUNT(*) FROM ({candidates} LIMIT ?)', candidate_params + [self.bbox_candidate_limit + 1]
+            ).fetchone()[0]
+            if count <= self.bbox_candidate_limit:
+                # CROSS JOIN keeps the candidates as the outer loop
+                source = f'({candidates}) AS candidates CROSS JOIN photos ON photos.rowid = candidates.id'
+                params = candidate_params + params
+
+        rs = self._run_read_query(f'''
+            SELECT {self._retrieve_columns.format(exif_data='NULL')}
+            FROM {source}
+            WHERE {' AND '.join(conditions)}
+            ORDER BY date_taken, filename
+            LIMIT ?
+        ''', params + [first])
+        return [self._to_processed_image(r, with_exif=False) for r in rs]
+
+    def get_thumbnail(self, filename, size=THUMBNAIL_SIZE):
+        # The stored size closest to what's asked for, preferring bigger ones over smaller
+        logger.debug(f'Retrieve {size} thumbnail for {filename}')
+        rs = self._run_read_query('''
+            SELECT thumbnail FROM thumbnails WHERE filename = ? ORDER BY size < ?, ABS(size - ?) LIMIT 1
+        ''', ( filename, size, size, ))
+        r = rs.fetchone()
+        return r[0] if r else None
     
+    def iter_located_thumbnails(self, start_date, end_date, size=THUMBNAIL_SIZE, chunk_size=256):
+        """
+        Lists of up to chunk_size (latitude, longitude, thumbnail) for every photo with a location taken between
+        two dates, from one query. The thumbnail is the stored size closest to size, as get_thumbnail picks it.
+        """
+        logger.debug(f'Getting locations and {size} thumbnails of files between {start_date} and {end_date}')
+        rs = self._run_read_query('''
+            SELECT latitude, longitude, thumbnail FROM (
+                SELECT
+                    photos.latitude,
+                    photos.longitude,
+                    thumbnails.thumbnail,
+                    ROW_NUMBER() OVER (
+                        PARTITION BY photos.filename ORDER BY thumbnails.size < :size, ABS(thumbnails.size - :size)
+                    ) AS closest
+                FROM photos JOIN thumbnails ON thumbnails.filename = photos.filename
+                WHERE photos.date_taken BETWEEN :start AND :end
+                AND photos.latitude IS NOT NULL AND photos.longitude IS NOT NULL AND photos.deleted = 0
+            )
+            WHERE closest = 1
+        ''', {'size': size, 'start': int(start_date.timestamp()), 'end': int(end_date.timestamp())})
+        while True:
+            rows = rs.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+
+    def get_thumbnail_by_id(self, photo_id, size=THUMBNAIL_SIZE, with_thumbnail=True):
+        """
+        As get_thumbnail, by photos rowid. Returns (hash, thumbnail), both None if there isn't one.
+        The thumbnail is None as well if not with_thumbnail, so the hash can be checked without reading it.
+        """
+        logger.debug(f'Retrieve {size} thumbnail for photo {photo_id}')
+        rs = self._run_read_query(f'''
+            SELECT thumbnails.hash, {'thumbnails.thumbnail' if with_thumbnail else 'NULL'}
+            FROM photos JOIN thumbnails ON thumbnails.filename = photos.filename
+            WHERE photos.rowid = ? ORDER BY thumbnails.size < ?, ABS(thumbnails.size - ?) LIMIT 1
+        ''', ( photo_id, size, size, ))
+        r = rs.fetchone()
+        return (r[0], r[1]) if r else (None, None)
+
     def commit(self):
         logger.debug('commit called, doing nothing')
         pass
@@ -207,17 +871,106 @@ class ProcessedImages(object):
 class LockingProcessedImages(ProcessedImages):
     def __init__(self, db_dir=None):
         super().__init__(db_dir)
-        self.lock = Lock()
+        self.lock = RLock()
 
     def _run_query(self, *args, **kwargs):
         with self.lock:
             return super()._run_query(*args, **kwargs)
 
+    def _run_many(self, *args, **kwargs):
+        with self.lock:
+            return super()._run_many(*args, **kwargs)
+
+    @contextmanager
+    def _transaction(self):
+        # Hold the lock for the whole transaction so nothing else lands in the middle of it
+        with self.lock:
+            with super()._transaction():
+                yield
+
+class CachingProcessedImages(LockingProcessedImages):
+    """
+    Keeps photos and date range lists that have been read in an LRU cache of up to cache_bytes.
+    Everything cached is dropped as soon as anything commits to the database, from this process or another.
+    Cached ProcessedImages are shared between callers, so they mustn't be changed.
+    """
+    def __init__(self, db_dir=None, cache_bytes=268435456):
+        super().__init__(db_dir=db_dir)
+        self.cache = ByteLRUCache(cache_bytes)
+        self.data_version = None
+        # Held while checking the version and clearing or adding to the cache, so they can't interleave
+        self.version_lock = Lock()
+
+    def _check_data_version(self):
+        # Clears the cache if the database has changed, returns the version to pass to _put for what's read next
+        with self.version_lock:
+            data_version = self.connections.get_data_version()
+            if data_version != self.data_version:
+                if self.data_version is not None:
+                    logger.debug('Database has changed, clearing cache')
+                self.cache.clear()
+                self.data_version = data_version
+            return data_version
+
+    def _put(self, data_version, items):
+        # items is a list of (key, value). Only cached if nothing has committed since data_version, otherwise they
+        # may have been read from before it.
+        with self.version_lock:
+            if data_version == self.data_version == self.connections.get_data_version():
+                for key, value in items:
+                    self.cache.put(key, value)
+
+    def _cached(self, key, load):
+        data_version = self._check_data_version()
+        value = self.cache.get(key)
+        if value is MISSING:
+            value = load()
+            self._put(data_version, [(key, value)])
+        return value
+
+    def retrieve(self, filename, with_thumbnail=True):
+        return self._cached(('retrieve', filename, with_thumbnail), lambda: super(CachingProcessedImages, self).retrieve(filename, with_thumbnail))
+
+    def retrieve_many(self, filenames, with_exif=True):
+        # Each photo is cached on its own, only the ones that aren't are read
+        data_version = self._check_data_version()
+        results = {}
+        missing = []
+        for filename in filenames:
+            p = self.cache.get(('retrieve_many', filename, with_exif))
+            if p is MISSING:
+                missing.append(filename)
+            elif p is not None:
+                results[filename] = p
+
+        if missing:
+            found = super().retrieve_many(missing, with_exif)
+            self._put(data_version, [(('retrieve_many', filename, with_exif), found.get(filename)) for filename in missing])
+            results.update(found)
+        return results
+
+    def get_file_list_date_range(self, start_date, end_date):
+        return self._cached(('date_range', start_date, end_date), lambda: super(CachingProcessedImages, self).get_file_list_date_range(start_date, end_date))
+
+    def get_photo_page(self, *args, **kwargs):
+        return self._cached(('page', args, tuple(sorted(kwargs.items()))), lambda: super(CachingProcessedImages, self).get_photo_page(*args, **kwargs))
+
+    def get_stats(self):
+        return self.cache.get_stats()
+
 class QueueingProcessedImages(LockingProcessedImages):
-    def __init__(self, db_dir=None):
+    def __init__(self, db_dir=None, max_queue_size=0, write_batch_size=500, write_batch_time=0.5):
         super().__init__(db_dir=db_dir)
         logger.debug('Created processed images queue')
-        self.add_queue = Queue()
+        # When bounded, add() blocks while the queue is full so producers can't run ahead of the writer
+        self.add_queue = Queue(maxsize=max_queue_size)
+
+        # Each write is up to write_batch_size rows, or whatever arrived within write_batch_time seconds
+        self.write_batch_size = write_batch_size
+        self.write_batch_time = write_batch_time
+
+        self.rows_written = 0
+        self.write_time = 0.0
 
     def start(self):
         logger.debug('Starting processed images queue')
@@ -226,7 +979,7 @@ class QueueingProcessedImages(LockingProcessedImages):
         self.add_thread.start()
 
     def stop(self):
-        # Signal to threads that we want them to stop
+        # Signal to threads that we want them to stop, anything queued before this is still written
         logger.debug('Sending None to queues to stop')
         self.add_queue.put(None)
 
@@ -237,25 +990,53 @@ class QueueingProcessedImages(LockingProcessedImages):
         # Wait for threads to exit and join
         logger.debug('Waiting for threads to finish')
         self.add_thread.join()
-        logger.debug('Stopped processed images queue')
+        logger.info(f'Stopped processed images queue: {self.get_stats()}')
 
         logger.debug('Stopping processed images queue')
         logger.debug('Sending commit')
         super().close()
 
+    def get_write_batch(self):
+        # Block for the first item, then take whatever else turns up until the batch is full or time runs out.
+        # Returns the batch, and if the shutdown signal was received.
+        item = self.add_queue.get()
+        batch = []
+        deadline = time.time() + self.write_batch_time
+        while item is not None:
+            batch.append(item)
+            if len(batch) >= self.write_batch_size:
+                return batch, False
+
+            try:
+                item = self.add_queue.get(timeout=max(deadline - time.time(), 0))
+            except Empty:
+                return batch, False
+        return batch, True
 
     def process_add_queue(self):
         while True:
-            item = self.add_queue.get()
-            if item is None:
+            batch, shutdown = self.get_write_batch()
+
+            if batch:
+                start = time.time()
+                super().add_many(batch)
+                self.write_time += time.time() - start
+                self.rows_written += len(batch)
+                logger.debug(f'wrote {len(batch)} rows from add queue, {self.add_queue.qsize()} items remaining')
+
+            for _ in range(len(batch) + shutdown):
                 self.add_queue.task_done()
+
+            if shutdown:
                 logger.debug('add queue recieved shutdown signal')
                 break
 
-            logger.debug(f'retrieved item from add queue, {self.add_queue.qsize()} items remaining')
-            
-            super().add(item)
-            self.add_queue.task_done()
+    def get_stats(self):
+        return {
+            'rows_written': self.rows_written,
+            'rows_per_second': self.rows_written / self.write_time if self.write_time else 0.0,
+            'queue_depth': self.add_queue.qsize()
+        }
 
     def add(self, metadata):
-        self.add_queue.put(metadata)
\ No newline at end of file
+        self.add_queue.put(metadata)
@@ -9,6 +9,9 @@ import { Map, Marker } from "pigeon-maps" // Photo Mini map
 import ReactJson from 'react-json-view' // Exif data display
 import Select from 'react-select' // Searchtype switch
 
+// Photoserver for graphql queries and thumbnails
+const PHOTOSERVER = 'http://127.0.0.1:5000';
+
 const HDRGROUPS = gql`query gethdrgroups {
   hdrgroups {
     group
@@ -20,15 +23,22 @@ const PHOTOLIST = gql`query getPhotolist($startdatetime: DateTime!, $enddatetime
   photolist(startdatetime: $startdatetime, enddatetime: $enddatetime)
 }`;
 
-// Get photo contents from a filename key
-const PHOTO = gql`query getPhoto($filename: String!) {
-  photo(filename: $filename) {
+// Get the contents of many photos from their filename keys in one request
+const PHOTOS = gql`query getPhotos($filenames: [String]!) {
+  photos(filenames: $filenames) {
     filetype
     filename
     datetaken
     latitude
     longitude
-    thumbnail
+    thumbnailurl
+  }
+}`;
+
+// Exif data is only fetched for a photo when it's shown
+const PHOTO_EXIF = gql`query getPhotoExif($filename: String!) {
+  photo(filename: $filename) {
+    filename
     exifdata
   }
 }`;
@@ -50,40 +60,53 @@ function MiniMap({latitude, longitude}) {
   )
 }
 
-function ExifData({exifdata}) {
+function ExifData({filename}) {
   const [isShown, setIsShown] = useState(false);
+  const {loading, error, data} = useQuery(PHOTO_EXIF, { variables: {filename}, skip: !isShown });
 
   return (
     <div>
       <p onClick={() => setIsShown(!isShown)}>
         Exif = (click to show/hide)
       </p>
-      {isShown && (<ReactJson src={JSON.parse(exifdata)} />)}
+      {isShown && loading && <p>Loading...</p>}
+      {isShown && error && <p>Error</p>}
+      {isShown && data && (<ReactJson src={JSON.parse(data.photo.exifdata)} />)}
     </div>
   )
 }
 
 
-// Render a Photo based on the graphql call, input is filename/key.
-function Photo({filename}) {
-  const {loading, error, data} = useQuery(PHOTO, { variables: {filename} });
-
-  if (loading) return <img alt='loading...' src='loading.gif'/>;
-  if (error) return <img alt='error' src='error.gif'/>;
+// Render a Photo from the results of a PHOTOS query.
+function Photo({photo}) {
+  if (!photo) return <img alt='error' src='error.gif'/>;
 
-  const thumbnail = "data:image/jpeg;base64, "+ data.photo.thumbnail;
+  // Served as a plain image so the browser can cache it
+  const thumbnail = PHOTOSERVER + photo.thumbnailurl;
 
   return (
     <div id='photo'>
-      <img alt={data.photo.filename} src={thumbnail}></img>
-      <p>Filename = {data.photo.filename}</p>
-      <p>Date Taken = {data.photo.datetaken}</p>
-      <MiniMap latitude={data.photo.latitude} longitude={data.photo.longitude} />
-      <ExifData exifdata={data.photo.exifdata} />
+      <img alt={photo.filename} src={thumbnail}></img>
+      <p>Filename = {photo.filename}</p>
+      <p>Date Taken = {photo.datetaken}</p>
+      <MiniMap latitude={photo.latitude} longitude={photo.longitude} />
+      <ExifData filename={photo.filename} />
     </div> 
   )
 }
 
+// Fetch every photo in a list of filenames in one request, then render them with renderPhotos,
+// which is given an object of filename -> photo.
+function Photos({filenames, renderPhotos}) {
+  const {loading, error, data} = useQuery(PHOTOS, { variables: {filenames} });
+
+  if (loading) return <p>Loading...</p>;
+  if (error) return <p>Error</p>;
+
+  const photos = Object.fromEntries(data.photos.filter(photo => photo).map(photo => [photo.filename, photo]));
+  return renderPhotos(photos);
+}
+
 // Render the full list of photos between a start and end date, calling graphql. 
 // Using masonry for layout and lazyload to prevent loading of offscreen elements.
 function PhotoList({startdatetime, enddatetime}) {
@@ -94,11 +117,13 @@ function PhotoList({startdatetime, enddatetime}) {
   if (data.photolist.length === 0) return <p>No photos found</p>;
 
   return (
-    <ResponsiveMasonry columnsCountBreakPoints={{522: 1, 1064: 2, 1596: 3}} >
-      <Masonry>
-        {data.photolist.map(filename => { return <LazyLoad key={filename} height='512px'><Photo filename={filename} /></LazyLoad>})}
-      </Masonry>
-    </ResponsiveMasonry>
+    <Photos filenames={data.photolist} renderPhotos={photos => (
+      <ResponsiveMasonry columnsCountBreakPoints={{522: 1, 1064: 2, 1596: 3}} >
+        <Masonry>
+          {data.photolist.map(filename => { return <LazyLoad key={filename} height='512px'><Photo photo={photos[filename]} /></LazyLoad>})}
+        </Masonry>
+      </ResponsiveMasonry>
+    )} />
   )
 }
 
@@ -110,15 +135,17 @@ function HDRPhotoList() {
   if (data.hdrgroups.length === 0) return <p>No photos found</p>;
 
   return (
-      <ResponsiveMasonry columnsCountBreakPoints={{522: 1, 1064: 2, 1596: 3}} >
-        <Masonry>
-          {data.hdrgroups.map(group => { return <LazyLoad key={group.group[0]} height='512px'>
-                                                  <Photo key={group.group[0]} filename={group.group[0]} />
-                                                  <Photo key={group.group[1]} filename={group.group[1]} />
-                                                  <Photo key={group.group[2]} filename={group.group[2]} />
-                                               </LazyLoad>})}
-        </Masonry>
-      </ResponsiveMasonry>
+      <Photos filenames={data.hdrgroups.flatMap(group => group.group)} renderPhotos={photos => (
+        <ResponsiveMasonry columnsCountBreakPoints={{522: 1, 1064: 2, 1596: 3}} >
+          <Masonry>
+            {data.hdrgroups.map(group => { return <LazyLoad key={group.group[0]} height='512px'>
+                                                    <Photo key={group.group[0]} photo={photos[group.group[0]]} />
+                                                    <Photo key={group.group[1]} photo={photos[group.group[1]]} />
+                                                    <Photo key={group.group[2]} photo={photos[group.group[2]]} />
+                                                 </LazyLoad>})}
+          </Masonry>
+        </ResponsiveMasonry>
+      )} />
     )
 }
 
@@ -158,7 +185,7 @@ function App() {
   // Graphql client, enable in memory caching to save repeat requests. 
   //Disable cors since we're using localhost.
   const client = new ApolloClient({
-    uri: 'http://127.0.0.1:5000/graphql',
+    uri: PHOTOSERVER + '/graphql',
     cache: new InMemoryCache(),
     fetchOptions: {
       mode: 'no-cors',